@@ -0,0 +1,337 @@
+import time
+import json
+import argparse
+import subprocess
+
+import numpy as np
+from scipy.ndimage import maximum_filter
+
+from classes import analyzer, calibration, connection
+from classes.tracker import ObjTracker
+from classes.profiler import StageProfiler
+
+
+class SyntheticPanel:
+    """
+    N個の移動するタッチとM個のblobを含む疑似センサフレームの生成
+    """
+
+    def __init__(self, n_touches=3, n_blobs=1, noise=0.01, seed=0):
+        self.rng = np.random.default_rng(seed)
+        self.positions = analyzer.sensor_positions().astype(np.float64)
+        self.noise = noise
+
+        self.cal_min = self.rng.integers(800, 1200, 121).astype(np.uint16)
+        self.cal_max = (self.cal_min + self.rng.integers(20000, 30000, 121)).astype(np.uint16)
+
+        # 各オブジェクトはリサージュ曲線上を移動する (x周波数, y周波数, 位相, 幅, 強さ)
+        self.touches = [(self.rng.uniform(0.2, 0.6), self.rng.uniform(0.2, 0.6), self.rng.uniform(0, np.pi * 2),
+                         12.0, 1.0) for _ in range(n_touches)]
+        self.blobs = [(self.rng.uniform(0.05, 0.2), self.rng.uniform(0.05, 0.2), self.rng.uniform(0, np.pi * 2),
+                       45.0, 0.8) for _ in range(n_blobs)]
+
+    def __add(self, level, objects, t):
+        for fx, fy, phase, sd, amp in objects:
+            x = 160 + 140 * np.sin(2 * np.pi * fx * t + phase)
+            y = 80 + 70 * np.sin(2 * np.pi * fy * t + phase * 0.5)
+            d2 = (self.positions[:, 0] - x) ** 2 + (self.positions[:, 1] - y) ** 2
+            level += amp * np.exp(-0.5 * d2 / (sd ** 2))
+
+    def frame(self, t):
+        """
+        時刻tのセンサフレーム
+        :param t: 時刻 [s]
+        :return: 121個のuint16センサ値
+        """
+        level = self.rng.normal(0.0, self.noise, 121)
+        self.__add(level, self.touches, t)
+        self.__add(level, self.blobs, t)
+        np.clip(level, 0.0, 1.0, out=level)
+
+        span = (self.cal_max - self.cal_min).astype(np.float64)
+        return (self.cal_min + level * span).astype(np.uint16)
+
+    def frames(self, n_frames, rate=60.0):
+        return [self.frame(i / rate) for i in range(n_frames)]
+
+
+def legacy_plot(sensor_data, grad_img, plot_size=(160, 320), grad_size=100, over_scan=60):
+    """
+    従来のセンサ毎ループによる描画（比較用）
+    """
+    extra_px = over_scan * 2
+    plot_img = np.zeros((plot_size[0] + extra_px, plot_size[1] + extra_px))
+    sens_height, sens_width = sensor_data.shape[:2]
+    xp = int(plot_size[1] / (sens_width - 1))
+    yp = int(plot_size[0] / (sens_height - 1))
+    grad_h = int(grad_size / 2)
+
+    for hi in range(sens_height):
+        for wi in range(sens_width):
+            y = (hi * yp) + over_scan
+            x = (wi * xp) + over_scan
+            plot_img[y - grad_h:y + grad_h, x - grad_h:x + grad_h] += grad_img * sensor_data[hi, wi]
+
+    plot_img[plot_img > 1.0] = 1.0
+    return plot_img
+
+
+def measure(func, frames):
+    """
+    各フレームの処理時間を計測
+    :return: 処理時間の配列 [s]
+    """
+    elapsed = np.zeros(len(frames))
+    for i, frame in enumerate(frames):
+        start = time.perf_counter()
+        func(frame)
+        elapsed[i] = time.perf_counter() - start
+    return elapsed
+
+
+def summarize(elapsed):
+    """
+    処理時間の統計 [ms]
+    """
+    ms = np.asarray(elapsed) * 1000
+    return {
+        "mean_ms": float(ms.mean()),
+        "p50_ms": float(np.percentile(ms, 50)),
+        "p95_ms": float(np.percentile(ms, 95)),
+        "p99_ms": float(np.percentile(ms, 99)),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def bench_pipeline(n_frames, n_touches, n_blobs, warmup=20, touch_only=False, scale=1.0):
+    """
+    Analyzerとトラッカーを用いた解析パイプライン全体の計測（GUI・センサ不要）
+    """
+    panel = SyntheticPanel(n_touches, n_blobs)
+    frames = panel.frames(n_frames + warmup)
+
+    t_frame = connection.TmFrame()
+    t_calibration = calibration.Calibration(t_frame, False)
+    t_calibration.set_data(panel.cal_min, panel.cal_max)
+
+    t_touch_track = ObjTracker()
+    t_blob_track = ObjTracker()
+    t_analyzer = analyzer.Analyzer(t_calibration, t_touch_track, t_blob_track, scale=scale)
+
+    if touch_only:
+        t_analyzer.set_mode(analyzer.Analyzer.MODE_TOUCH)
+
+    t_analyzer.profiler = StageProfiler(window=n_frames)
+
+    total = []
+    for i, data in enumerate(frames):
+        t_frame.set_frame(data)
+        seq, frame = t_frame.get_frame()
+
+        start = time.perf_counter()
+        t_analyzer.analyze(frame)
+        if i >= warmup:
+            total.append(time.perf_counter() - start)
+        elif i == warmup - 1:
+            t_analyzer.profiler.reset()
+
+    result = {
+        "frames": n_frames,
+        "touches": n_touches,
+        "blobs": n_blobs,
+        "touch_only": touch_only,
+        "scale": scale,
+        "throughput_fps": float(len(total) / np.sum(total)),
+        "total": summarize(total),
+        "stages": t_analyzer.get_stage_stat(),
+    }
+
+    print("pipeline: {} touches, {} blobs, {} frames, scale {}{}".format(n_touches, n_blobs, n_frames, scale,
+                                                                         " (touch only)" if touch_only else ""))
+    print("  throughput  : {:8.1f} frames/s".format(result["throughput_fps"]))
+    for name, stat in [("total", result["total"])] + list(result["stages"].items()):
+        print("  {:<20}: p50 {:7.3f}  p95 {:7.3f}  p99 {:7.3f} ms".format(
+            name, stat["p50_ms"], stat["p95_ms"], stat["p99_ms"]))
+    return result
+
+
+def rendered_frames(n_frames, n_touches=3, n_blobs=1):
+    """
+    SyntheticPanel のフレームを合成画像まで処理したもの
+    """
+    panel = SyntheticPanel(n_touches, n_blobs)
+    t_calibration = calibration.Calibration(connection.TmFrame(), False)
+    t_calibration.set_data(panel.cal_min, panel.cal_max)
+    t_analyzer = analyzer.Analyzer(t_calibration, ObjTracker(), ObjTracker())
+
+    images = []
+    for data in panel.frames(n_frames):
+        calc = t_analyzer.tone_curve(t_calibration.get_calibrated_data(data))
+        images.append(t_analyzer.plot(t_analyzer.to_grid(calc)).copy())
+    return images
+
+
+def bench_labeling(n_frames, n_touches, n_blobs):
+    images = rendered_frames(n_frames, n_touches, n_blobs)
+
+    def blob_key(blobs):
+        return [(b.point, b.point1, b.point2, b.shape.tobytes()) for b in blobs]
+
+    mismatch = 0
+    for img in images:
+        mask_blobs, blobs = analyzer.detect_objects(img, (0.5, 0.1))
+        if blob_key(mask_blobs) != blob_key(analyzer.detect_object(img, 0.5)) or \
+                blob_key(blobs) != blob_key(analyzer.detect_object(img, 0.1)):
+            mismatch += 1
+
+    separate = measure(lambda f: (analyzer.detect_object(f, 0.5), analyzer.detect_object(f, 0.1)), images)
+    single = measure(lambda f: analyzer.detect_objects(f, (0.5, 0.1)), images)
+
+    print("labeling: {} / {} frames differ".format(mismatch, n_frames))
+    print("  detect_object x2 : {:8.3f} ms/frame".format(separate.mean() * 1000))
+    print("  detect_objects   : {:8.3f} ms/frame".format(single.mean() * 1000))
+    print("  saved            : {:8.3f} ms/frame".format((separate.mean() - single.mean()) * 1000))
+
+    return {"mismatch": mismatch, "detect_object_x2": summarize(separate), "detect_objects": summarize(single)}
+
+
+def bench_plot(n_frames):
+    rng = np.random.default_rng(0)
+    led_insert_pos = analyzer.insert_led()
+    frames = [np.reshape(np.insert(rng.random(121), led_insert_pos, 0), (11, 22)) for _ in range(n_frames)]
+
+    grad_img = analyzer.gauss2d(100, 16)
+    splatter = analyzer.get_splatter((160, 320), (11, 22), 100, 16, 60)
+    out = np.zeros((280, 440))
+
+    error = max(np.abs(legacy_plot(f, grad_img) - splatter.render(f, out=out)).max() for f in frames)
+
+    legacy = measure(lambda f: legacy_plot(f, grad_img), frames)
+    splat = measure(lambda f: splatter.render(f, out=out), frames)
+
+    print("plot: max abs error {:.3e}".format(error))
+    print("  legacy loop : {:8.3f} ms/frame".format(legacy.mean() * 1000))
+    print("  splatter    : {:8.3f} ms/frame".format(splat.mean() * 1000))
+    print("  speedup     : {:8.1f}x".format(legacy.mean() / splat.mean()))
+
+    return {"max_error": float(error), "legacy": summarize(legacy), "splatter": summarize(splat)}
+
+
+def legacy_detect_touch(img, mask_blobs, threshold=0.1):
+    """
+    以前の detect_touch（比較用，ラスタ順に最大12個）
+    """
+    tmp_img = img.copy()
+    for blob in mask_blobs:
+        tmp_img[blob.point1[1]:blob.point2[1], blob.point1[0]:blob.point2[0]] = 0.0
+    tmp_img[tmp_img > 0.9] = 0.0
+    tmp_img[tmp_img < 0.05] = 0.0
+
+    local_max = maximum_filter(tmp_img, footprint=np.ones((10, 10)), mode="constant")
+    detected_peaks = np.ma.array(tmp_img, mask=~(tmp_img == local_max))
+
+    tmp = np.ma.array(detected_peaks, mask=~(detected_peaks >= detected_peaks.max() * threshold))
+    peaks_index = np.where(~tmp.mask)
+
+    touches = []
+    if len(peaks_index[0]) > 5000:
+        return touches
+
+    for i in range(len(peaks_index[0])):
+        touches.append((peaks_index[1][i].item(), peaks_index[0][i].item()))
+        if i > 10:
+            break
+    return touches
+
+
+def bench_touch(n_frames, n_touches, n_blobs):
+    images = rendered_frames(n_frames, n_touches, n_blobs)
+    masks = [analyzer.detect_objects(img, (0.5, 0.1))[0] for img in images]
+    finder = analyzer.PeakFinder()
+
+    # 12個以下のフレームは同じ集合になる
+    mismatch = 0
+    for img, mask_blobs in zip(images, masks):
+        legacy = legacy_detect_touch(img, mask_blobs, 0.05)
+        peaks = [touch.point for touch in finder.find(img, mask_blobs, 0.05)]
+        if len(legacy) < 12 and sorted(legacy) != sorted(peaks):
+            mismatch += 1
+
+    pairs = list(zip(images, masks))
+    legacy = measure(lambda p: legacy_detect_touch(p[0], p[1], 0.05), pairs)
+    fast = measure(lambda p: finder.find(p[0], p[1], 0.05), pairs)
+
+    print("touch: {} / {} frames differ".format(mismatch, n_frames))
+    print("  masked arrays : {:8.3f} ms/frame".format(legacy.mean() * 1000))
+    print("  PeakFinder    : {:8.3f} ms/frame".format(fast.mean() * 1000))
+
+    return {"mismatch": mismatch, "legacy": summarize(legacy), "peak_finder": summarize(fast)}
+
+
+def legacy_calibrated(cal_min, cal_range, data):
+    """
+    以前の Calibration.get_calibrated_data（比較用，data を変更する）
+    """
+    data[data < cal_min] = cal_min[data < cal_min]
+    offset = data - cal_min
+    offset[offset > cal_range] = cal_range[offset > cal_range]
+    calc = (offset / cal_range)
+    calc[calc > 1.0] = 1.0
+    return calc
+
+
+def bench_calibration(n_frames, n_touches, n_blobs):
+    panel = SyntheticPanel(n_touches, n_blobs)
+    frames = panel.frames(n_frames)
+    t_calibration = calibration.Calibration(connection.TmFrame(), False)
+    t_calibration.set_data(panel.cal_min, panel.cal_max)
+    out = np.zeros(121, np.float32)
+
+    error = max(np.abs(legacy_calibrated(panel.cal_min, t_calibration.range, f.copy()) -
+                       t_calibration.get_calibrated_data(f, out=out)).max() for f in frames)
+
+    legacy = measure(lambda f: legacy_calibrated(panel.cal_min, t_calibration.range, f.copy()), frames)
+    fused = measure(lambda f: t_calibration.get_calibrated_data(f, out=out), frames)
+
+    print("calibration: max abs error {:.3e}".format(error))
+    print("  legacy masks : {:8.2f} us/frame".format(legacy.mean() * 1e6))
+    print("  fused        : {:8.2f} us/frame".format(fused.mean() * 1e6))
+
+    return {"max_error": float(error), "legacy": summarize(legacy), "fused": summarize(fused)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TouchMatrix analysis benchmark")
+    parser.add_argument("--target", action="append", choices=["pipeline", "plot", "labeling", "calibration", "touch"])
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--touches", type=int, default=3)
+    parser.add_argument("--blobs", type=int, default=1)
+    parser.add_argument("--touch-only", action="store_true", help="run the pipeline in touch-only mode")
+    parser.add_argument("--scale", type=float, default=1.0, help="analysis resolution scale")
+    parser.add_argument("--output", help="save the results as JSON")
+    args = parser.parse_args()
+    targets = args.target or ["pipeline", "plot", "labeling", "calibration", "touch"]
+
+    results = {"revision": git_revision(), "time": time.time()}
+    if "pipeline" in targets:
+        results["pipeline"] = bench_pipeline(args.frames, args.touches, args.blobs,
+                                             touch_only=args.touch_only, scale=args.scale)
+    if "plot" in targets:
+        results["plot"] = bench_plot(args.frames)
+    if "labeling" in targets:
+        results["labeling"] = bench_labeling(args.frames, args.touches, args.blobs)
+    if "touch" in targets:
+        results["touch"] = bench_touch(args.frames, args.touches, args.blobs)
+    if "calibration" in targets:
+        results["calibration"] = bench_calibration(args.frames, args.touches, args.blobs)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to {}".format(args.output))
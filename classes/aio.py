@@ -0,0 +1,218 @@
+import asyncio
+import threading
+import collections
+from collections.abc import Iterable
+
+import serial
+
+from pythonosc import osc_message_builder
+from pythonosc import osc_server
+
+from classes.connection import SerialServer, OSCServer, ObjTransmitter
+
+
+class IoRuntime:
+    """
+    受信・送信を1つの asyncio イベントループ（1スレッド）で行う
+    シリアル受信・OSC受信・OSC送信はループ上のノンブロッキング処理として登録する
+    """
+
+    def __init__(self):
+        self.loop = None
+        self.thread = None
+        self.ready = threading.Event()
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self.__run, daemon=True)
+        self.thread.start()
+        self.ready.wait()
+
+    def __run(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self.ready.set)
+        self.loop.run_forever()
+        self.loop.close()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.thread = None
+        self.ready.clear()
+
+    def call(self, callback, *args):
+        """
+        ループのスレッドで callback を実行（戻り値は待たない）
+        """
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    def run(self, coro, timeout=None):
+        """
+        ループでコルーチンを実行し，結果を待つ
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result(timeout)
+
+
+class AsyncSerialServer(SerialServer):
+    """
+    SerialServer のイベントループ版
+    受信スレッドの代わりにシリアルポートのファイルディスクリプタを add_reader で監視する（POSIXのみ）
+    """
+
+    def __init__(self, tm_frame, runtime, dev="/dev/ttyACM0", baud=115200):
+        super().__init__(tm_frame, dev, baud)
+        self.runtime = runtime
+        self.serial = None
+
+    def __on_readable(self):
+        try:
+            chunk = self.serial.read(self.serial.in_waiting or 1)
+        except serial.SerialException as e:
+            print("Error : {}".format(e))
+            self.__close()
+            return
+        if not chunk:
+            return
+        self.received_bytes += len(chunk)
+        self.decode(chunk)
+
+    def __open(self):
+        try:
+            self.serial = serial.Serial(self.dev, self.baud, timeout=0)
+            self.runtime.loop.add_reader(self.serial.fileno(), self.__on_readable)
+        except (serial.SerialException, OSError, NotImplementedError) as e:
+            print("Error : {}".format(e))
+            self.serial = None
+            self.running = False
+
+    def __close(self):
+        if self.serial is not None:
+            self.runtime.loop.remove_reader(self.serial.fileno())
+            self.serial.close()
+            self.serial = None
+        self.running = False
+
+    def start_server(self):
+        print("Starting Server")
+        print("Serving on {}".format(self.dev))
+        self.decoder.reset()
+        self.running = True
+        self.runtime.call(self.__open)
+
+    def stop(self):
+        if self.running:
+            self.runtime.run(self.__stop())
+
+    async def __stop(self):
+        self.__close()
+
+
+class AsyncOSCServer(OSCServer):
+    """
+    OSCServer のイベントループ版（受信スレッドなし）
+    """
+
+    def __init__(self, tm_frame, runtime, ip="127.0.0.1", port=7000):
+        super().__init__(tm_frame, ip, port)
+        self.runtime = runtime
+        self.transport = None
+
+    def start_server(self):
+        print("Starting Server")
+        server = osc_server.AsyncIOOSCUDPServer((self.ip, self.port), self.dispatcher, self.runtime.loop)
+        try:
+            self.transport, protocol = self.runtime.run(server.create_serve_endpoint())
+        except OSError:
+            print("Error : Wrong Address")
+            return
+        print("Serving on {}".format((self.ip, self.port)))
+        self.running = True
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.runtime.call(self.transport.close)
+
+
+class QueuedUDPClient:
+    """
+    SimpleUDPClient と同じ send / send_message を持つ送信キュー
+    呼び出し側のスレッドではメッセージの生成とキューへの追加のみを行い，送信はイベントループで行う
+    キューが一杯なら古いものから捨てる
+    """
+
+    def __init__(self, runtime, ip, port, maxsize=256):
+        self.runtime = runtime
+        self.queue = collections.deque(maxlen=maxsize)
+        self.lock = threading.Lock()
+        self.scheduled = False
+        self.dropped = 0
+
+        self.transport, protocol = runtime.run(
+            runtime.loop.create_datagram_endpoint(asyncio.DatagramProtocol, remote_addr=(ip, port)))
+
+    def send(self, content):
+        self.__put(content.dgram)
+
+    def send_message(self, address, value):
+        builder = osc_message_builder.OscMessageBuilder(address=address)
+        if value is None:
+            pass
+        elif not isinstance(value, Iterable) or isinstance(value, (str, bytes)):
+            builder.add_arg(value)
+        else:
+            for val in value:
+                builder.add_arg(val)
+        self.__put(builder.build().dgram)
+
+    def __put(self, dgram):
+        with self.lock:
+            if len(self.queue) == self.queue.maxlen:
+                self.dropped += 1
+            self.queue.append(dgram)
+            if self.scheduled:
+                return
+            self.scheduled = True
+        # 既に送信が予約されていればループを起こさない
+        self.runtime.call(self.__flush)
+
+    def __flush(self):
+        with self.lock:
+            dgrams = list(self.queue)
+            self.queue.clear()
+            self.scheduled = False
+        for dgram in dgrams:
+            self.transport.sendto(dgram)
+
+    def close(self):
+        self.runtime.call(self.transport.close)
+
+
+class AsyncObjTransmitter(ObjTransmitter):
+    """
+    ObjTransmitter のイベントループ版
+    Analyzer のスレッドはキューに積むだけで，ソケットへの書き込みを待たない
+    """
+
+    def __init__(self, runtime, ip="127.0.0.1", port=9000, mode=ObjTransmitter.MODE_MESSAGE):
+        super().__init__(ip, port, mode)
+        self.runtime = runtime
+
+    def start_client(self):
+        print("Starting Obj Client")
+        if isinstance(self.client, QueuedUDPClient):
+            self.client.close()
+        self.client = QueuedUDPClient(self.runtime, self.ip, self.port)
+        self.pending.clear()
+        self.rate_meter.reset()
+        self.running = True
+        print("Sending on {}".format(self.ip))
+
+    def stop(self):
+        super().stop()
+        if isinstance(self.client, QueuedUDPClient):
+            self.client.close()
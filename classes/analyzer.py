@@ -1,11 +1,15 @@
 import math
-import time
 import threading
+from functools import lru_cache
 import numpy as np
 import cv2
-from scipy.ndimage import maximum_filter
 
 from classes.tracker import Touch, Blob
+from classes.profiler import StageProfiler, RateMeter
+from classes import filters
+
+
+REFERENCE_SIZE = (160, 320)     # 出力座標系の解像度 (縦, 横)
 
 
 def intr(sensor_data):
@@ -38,6 +42,73 @@ def gauss2d(size, sd):
     return grad
 
 
+def gauss1d(size, sd):
+    """
+    ガウス分布の1次元プロファイル（gauss2dの分離形）
+    :param size: 解像度
+    :param sd: 標準偏差
+    :return: numpy配列
+    """
+    x = np.arange(size) - size / 2
+    return np.exp((-0.5) * (x / sd) ** 2)
+
+
+def splat_operator(length, steps, step, grad, offset):
+    """
+    1軸分の描画オペレータを生成
+    各センサ位置にプロファイルを配置した行列 (length, steps)
+    :param length: 出力画像の画素数（オーバースキャン込み）
+    :param steps: センサ数
+    :param step: センサ間隔 [px]
+    :param grad: 1次元プロファイル
+    :param offset: オーバースキャン [px]
+    :return: numpy配列
+    """
+    grad_h = int(grad.shape[0] / 2)
+    op = np.zeros((length, steps))
+    for i in range(steps):
+        center = (i * step) + offset
+        op[center - grad_h:center + grad_h, i] = grad[:grad_h * 2]
+    return op
+
+
+class GaussSplatter:
+    """
+    センサ値のガウス分布描画を行列積1回で行う
+    gauss2d は分離可能なので plot = Ay @ sensor @ Ax となる
+    """
+
+    def __init__(self, plot_size, sens_shape, grad_size, sd, over_scan):
+        sens_height, sens_width = sens_shape
+        xp = int(plot_size[1] / (sens_width - 1))  # step x
+        yp = int(plot_size[0] / (sens_height - 1))  # step y
+        extra_px = over_scan * 2
+
+        grad = gauss1d(grad_size, sd)
+        self.op_y = splat_operator(plot_size[0] + extra_px, sens_height, yp, grad, over_scan)
+        self.op_x = np.ascontiguousarray(
+            splat_operator(plot_size[1] + extra_px, sens_width, xp, grad, over_scan).T)
+
+    def render(self, sensor_data, out=None):
+        """
+        センサ値を描画
+        :param sensor_data: (センサ行, センサ列) の配列
+        :param out: 出力先の配列（Noneなら確保）
+        :return: 描画結果
+        """
+        out = np.matmul(self.op_y @ sensor_data, self.op_x, out=out)
+        np.minimum(out, 1.0, out=out)
+        return out
+
+
+@lru_cache(maxsize=8)
+def get_splatter(plot_size, sens_shape, grad_size, sd, over_scan):
+    """
+    パラメータ毎に描画オペレータをキャッシュ
+    """
+    return GaussSplatter(plot_size, sens_shape, grad_size, sd, over_scan)
+
+
 def insert_led():
     """
     センサ配列に対して千鳥格子状にブランクを差し込む
@@ -49,6 +120,98 @@ def insert_led():
     return pos
 
 
+def sensor_positions(plot_size=(160, 320)):
+    """
+    各センサの合成画像上の座標
+    :param plot_size: 合成画像の解像度 (縦, 横)
+    :return: (121, 2) の配列．各行は (x, y)
+    """
+    grid = np.reshape(np.insert(np.arange(121), insert_led(), -1), (11, 22))
+    rows, cols = np.nonzero(grid >= 0)
+    order = np.argsort(grid[rows, cols])
+    xp = int(plot_size[1] / (grid.shape[1] - 1))
+    yp = int(plot_size[0] / (grid.shape[0] - 1))
+    return np.stack([cols[order] * xp, rows[order] * yp], axis=1)
+
+
+@lru_cache(maxsize=None)
+def sensor_mask():
+    """
+    (11, 22) の格子のうちセンサがある位置
+    """
+    mask = np.reshape(np.insert(np.ones(121, bool), insert_led(), False), (11, 22))
+    mask.flags.writeable = False
+    return mask
+
+
+# 千鳥格子上で隣接するセンサ (dy, dx)
+GRID_NEIGHBOURS = ((-1, -1), (-1, 1), (1, -1), (1, 1), (0, -2), (0, 2), (-2, 0), (2, 0))
+
+
+def refine_peaks(pad, rows, cols, pitch):
+    """
+    ピークとその近傍8センサの対数値に等方的なガウス関数を重み付き最小二乗で当てはめ，サブピクセル位置を求める
+    外側・センサのない位置は重み0として扱う
+    :param pad: 2セル分ゼロ埋めした格子
+    :param rows: ピークの行
+    :param cols: ピークの列
+    :param pitch: 格子の間隔 [px] (縦, 横)
+    :return: (x方向, y方向) の補正量 [px]
+    """
+    offsets = np.array(((0, 0),) + GRID_NEIGHBOURS)
+    px = offsets[:, 1] * pitch[1]
+    py = offsets[:, 0] * pitch[0]
+    design = np.stack([np.ones(px.shape[0]), px, py, px ** 2 + py ** 2], axis=1)
+
+    values = pad[rows[:, None] + 2 + offsets[:, 0], cols[:, None] + 2 + offsets[:, 1]]
+    weight = np.clip(values, 0.0, None)
+    log_values = np.log(np.where(values > 0, values, 1.0))
+
+    normal = np.einsum('nk,ki,kj->nij', weight, design, design) + np.eye(4) * 1e-9
+    rhs = np.einsum('nk,ki,nk->ni', weight, design, log_values)
+    coef = np.linalg.solve(normal, rhs[..., None])[..., 0]
+
+    curvature = coef[:, 3]
+    valid = curvature < 0
+    safe = np.where(valid, curvature, -1.0)
+    dx = np.where(valid, -coef[:, 1] / (2 * safe), 0.0)
+    dy = np.where(valid, -coef[:, 2] / (2 * safe), 0.0)
+    return np.clip(dx, -pitch[1], pitch[1]), np.clip(dy, -pitch[0], pitch[0])
+
+
+def detect_touch_grid(grid, threshold=0.05, noise=0.05, max_touches=12, plot_size=(160, 320)):
+    """
+    合成画像を作らずに千鳥格子上の局所最大値からタッチを検出
+    :param grid: 千鳥格子状のセンサ値 (11, 22)
+    :param threshold: 最大値に対する閾値
+    :param noise: ノイズとみなす値
+    :param max_touches: 最大検出数
+    :param plot_size: 出力座標系の解像度 (縦, 横)
+    :return: Touchのリスト（合成画像と同じ座標系，強い順）
+    """
+    h, w = grid.shape
+    pad = np.pad(grid, 2)
+
+    peak = sensor_mask() & (grid > noise)
+    for dy, dx in GRID_NEIGHBOURS:
+        peak &= grid >= pad[2 + dy:2 + dy + h, 2 + dx:2 + dx + w]
+
+    rows, cols = np.nonzero(peak)
+    if rows.shape[0] == 0:
+        return []
+    values = grid[rows, cols]
+    order = np.argsort(-values)
+    order = order[values[order] >= values[order[0]] * threshold][:max_touches]
+    rows, cols = rows[order], cols[order]
+
+    xp = int(plot_size[1] / (w - 1))
+    yp = int(plot_size[0] / (h - 1))
+    dx, dy = refine_peaks(pad, rows, cols, (yp, xp))
+    x = cols * xp + dx
+    y = rows * yp + dy
+    return [Touch([x[i], y[i]]) for i in range(rows.shape[0])]
+
+
 def draw_centroids(src_img, centroids):
     """
     ラベリング結果の重心を画像に描画する
@@ -65,34 +228,101 @@ def draw_centroids(src_img, centroids):
     return centroids_img
 
 
-def detect_touch(img, mask_blobs, threshold=0.1):
+class PeakFinder:
+    """
+    合成画像の局所最大値の検出
+    作業用の配列は画像サイズ毎に1回だけ確保し，フレーム毎には再利用する
+    """
+
+    def __init__(self, max_peaks=12, max_candidates=5000):
+        """
+        :param max_peaks: 最大検出数（強い順）
+        :param max_candidates: 局所最大値がこれより多いフレームはノイズとみなす
+        """
+        self.max_peaks = max_peaks
+        self.max_candidates = max_candidates
+        self.shape = None
+        self.footprint = None
+        self.kernels = None
+        self.work = None
+        self.row_max = None
+        self.local_max = None
+        self.mask = None
+        self.strong = None
+
+    def __alloc(self, shape):
+        self.shape = shape
+        self.work = np.empty(shape, np.float32)
+        self.row_max = np.empty(shape, np.float32)
+        self.local_max = np.empty(shape, np.float32)
+        self.mask = np.empty(shape, bool)
+        self.strong = np.empty(shape, bool)
+
+    def find(self, img, mask_blobs, threshold=0.1, footprint=10):
+        """
+        :param img: グラデーション画像
+        :param mask_blobs: 除外するBlobのリスト
+        :param threshold: 最大値に対する閾値
+        :param footprint: 局所最大値を探す範囲 [px]
+        :return: Touchのリスト（強い順）
+        """
+        if img.shape != self.shape:
+            self.__alloc(img.shape)
+        if footprint != self.footprint:
+            # scipy.ndimage.maximum_filter(size=footprint) と同じ窓 (-footprint//2 ... (footprint-1)//2)
+            self.footprint = footprint
+            self.kernels = (np.ones((footprint, 1), np.uint8), (0, footprint // 2),
+                            np.ones((1, footprint), np.uint8), (footprint // 2, 0))
+        work = self.work
+        mask = self.mask
+
+        np.copyto(work, img)
+        for blob in mask_blobs:
+            work[blob.point1[1]:blob.point2[1], blob.point1[0]:blob.point2[0]] = 0.0
+        np.greater(work, 0.9, out=mask)
+        np.copyto(work, 0.0, where=mask)
+        np.less(work, 0.05, out=mask)   # ノイズの除去
+        np.copyto(work, 0.0, where=mask)
+
+        top = work.max()
+        if top <= 0:
+            return []
+
+        # 分離可能な最大値フィルタ（縦・横の1次元膨張，外側は0）
+        col_kernel, col_anchor, row_kernel, row_anchor = self.kernels
+        cv2.dilate(work, col_kernel, dst=self.row_max, anchor=col_anchor,
+                   borderType=cv2.BORDER_CONSTANT, borderValue=0)
+        cv2.dilate(self.row_max, row_kernel, dst=self.local_max, anchor=row_anchor,
+                   borderType=cv2.BORDER_CONSTANT, borderValue=0)
+
+        np.equal(work, self.local_max, out=mask)
+        np.greater_equal(work, top * threshold, out=self.strong)
+        mask &= self.strong
+
+        index = np.flatnonzero(mask)
+        if index.shape[0] > self.max_candidates:
+            return []
+
+        values = work.ravel()[index]
+        if index.shape[0] > self.max_peaks:
+            selected = np.argpartition(-values, self.max_peaks - 1)[:self.max_peaks]
+            index = index[selected]
+            values = values[selected]
+        index = index[np.argsort(-values, kind="stable")]
+
+        ys, xs = np.divmod(index, self.shape[1])
+        return [Touch([xs[i].item(), ys[i].item()]) for i in range(index.shape[0])]
+
+
+def detect_touch(img, mask_blobs, threshold=0.1, footprint=10):
     """
     グラデーション画像の局所最大値を計算
     :param img: グラデーション画像
     :param threshold: threshold
-    :return: 局所最大値を持つ画素の座標
+    :param footprint: 局所最大値を探す範囲 [px]
+    :return: 局所最大値を持つ画素の座標（強い順に最大12個）
     """
-    tmp_img = img.copy()
-    for blob in mask_blobs:
-        tmp_img[blob.point1[1]:blob.point2[1], blob.point1[0]:blob.point2[0]] = 0.0
-    tmp_img[tmp_img > 0.9] = 0.0
-    tmp_img[tmp_img < 0.05] = 0.0  # ノイズの除去
-
-    local_max = maximum_filter(tmp_img, footprint=np.ones((10, 10)), mode="constant")
-    detected_peaks = np.ma.array(tmp_img, mask=~(tmp_img == local_max))
-
-    tmp = np.ma.array(detected_peaks, mask=~(detected_peaks >= detected_peaks.max() * threshold))
-    peaks_index = np.where(~tmp.mask)
-
-    touches = []
-    if len(peaks_index[0]) > 5000:
-        return touches
-
-    for i in range(len(peaks_index[0])):
-        touches.append(Touch([peaks_index[1][i].item(), peaks_index[0][i].item()]))
-        if i > 10:
-            break
-    return touches
+    return PeakFinder().find(img, mask_blobs, threshold, footprint)
 
 
 def detect_object(img, threshold=0.1):
@@ -108,29 +338,111 @@ def detect_object(img, threshold=0.1):
     tmp8bit = (tmp_img * 255).astype(np.uint8)  # 8bitのスケールへ変換
     ret, tmp = cv2.threshold(tmp8bit, 0, 255, cv2.THRESH_OTSU)
 
-    retval, labels, stats, centroids = cv2.connectedComponentsWithStats(tmp)  # Labeling
+    return extract_blobs(tmp)
 
-    # blobを抽出
-    blobs = []
-    for i in range(1, len(centroids)):
-        coordinate = stats[i]
-        center = centroids[i]
-        left_top = (coordinate[0].item(), coordinate[1].item())
-        right_bottom = (coordinate[0].item() + coordinate[2].item(), coordinate[1].item() + coordinate[3].item())
-        shape = tmp[left_top[1]:left_top[1] + right_bottom[1], left_top[0]:left_top[0] + right_bottom[0]]
 
-        if right_bottom[1] - left_top[1] > 100 and right_bottom[0] - left_top[1] > 100:
-            blobs.append(Blob(center, left_top, right_bottom, shape))
+def otsu_threshold(hist):
+    """
+    ヒストグラムから判別分析法の閾値を計算（cv2.THRESH_OTSU と同じ定義）
+    :param hist: 256階調のヒストグラム
+    :return: 閾値
+    """
+    eps = np.finfo(np.float32).eps
+    p = hist / max(hist.sum(), 1)
+    q1 = np.cumsum(p)
+    q2 = 1.0 - q1
+    m1 = np.cumsum(np.arange(256) * p)
+    mu = m1[-1]
+
+    valid = (np.minimum(q1, q2) >= eps) & (np.maximum(q1, q2) <= 1.0 - eps)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mu1 = m1 / q1
+        mu2 = (mu - m1) / q2
+        sigma = q1 * q2 * (mu1 - mu2) ** 2
+    sigma = np.where(valid, sigma, 0.0)
+    return int(np.argmax(sigma)) if sigma.max() > 0 else 0
+
+
+def extract_blobs(binary, min_size=100):
+    """
+    二値画像をラベリングし，一定サイズ以上の領域をBlobとして抽出
+    :param binary: 二値画像 (0 or 255)
+    :param min_size: 最小サイズ [px]
+    :return: Blobのリスト
+    """
+    retval, labels, stats, centroids = cv2.connectedComponentsWithStats(binary, ltype=cv2.CV_16U)  # Labeling
+
+    # サイズ判定をまとめて行う
+    stats = stats[1:]
+    left = stats[:, cv2.CC_STAT_LEFT]
+    top = stats[:, cv2.CC_STAT_TOP]
+    right = left + stats[:, cv2.CC_STAT_WIDTH]
+    bottom = top + stats[:, cv2.CC_STAT_HEIGHT]
+    selected = np.flatnonzero((bottom - top > min_size) & (right - top > min_size))
 
+    blobs = []
+    for i in selected.tolist():
+        left_top = (left[i].item(), top[i].item())
+        right_bottom = (right[i].item(), bottom[i].item())
+        shape = binary[left_top[1]:left_top[1] + right_bottom[1], left_top[0]:left_top[0] + right_bottom[0]]
+        blobs.append(Blob(centroids[i + 1], left_top, right_bottom, shape))
     return blobs
 
 
+def detect_objects(img, thresholds, min_size=100):
+    """
+    複数の閾値での detect_object をまとめて行う
+    8bit変換は1回のみ．各閾値のヒストグラムはマスク付きで計算し，判別分析の閾値はヒストグラムから求める
+    結果は閾値毎に detect_object と同じ
+    :param img: グラデーション画像
+    :param thresholds: 閾値のリスト
+    :param min_size: Blobの最小サイズ [px]
+    :return: 閾値毎のBlobのリスト
+    """
+    tmp8bit = (img * 255).astype(np.uint8)  # 8bitのスケールへ変換
+
+    results = []
+    for threshold in thresholds:
+        mask = cv2.compare(img, threshold, cv2.CMP_GE)
+        hist = cv2.calcHist([tmp8bit], [0], mask, [256], [0, 256]).ravel().astype(np.float64)
+        hist[0] += img.size - hist.sum()      # 閾値未満は0として扱う
+
+        otsu = otsu_threshold(hist)
+        binary = cv2.bitwise_and(cv2.compare(tmp8bit, otsu, cv2.CMP_GT), mask)
+        results.append(extract_blobs(binary, min_size))
+    return results
+
+
+def to_reference(touches, blobs, factor):
+    """
+    検出結果を出力座標系 (REFERENCE_SIZE) へ変換
+    センサ間隔の比で拡大するため，画像端の座標は出力座標系の範囲に収める
+    :param touches: Touchのリスト
+    :param blobs: Blobのリスト
+    :param factor: (x方向, y方向) の倍率
+    :return: (touches, blobs)
+    """
+    fx, fy = factor
+    height, width = REFERENCE_SIZE
+
+    def convert(point):
+        return min(max(point[0] * fx, 0), width), min(max(point[1] * fy, 0), height)
+
+    touches = [Touch(convert(touch.point)) for touch in touches]
+    blobs = [Blob(convert(blob.point), convert(blob.point1), convert(blob.point2), blob.shape) for blob in blobs]
+    return touches, blobs
+
+
 class Analyzer(threading.Thread):
 
-    def __init__(self, calibration, touch_tracker, blob_tracker):
+    MODE_FULL = 0       # 合成画像からタッチとブロブを検出
+    MODE_TOUCH = 1      # センサ値から直接タッチのみを検出
+
+    def __init__(self, calibration, touch_tracker, blob_tracker, scale=1.0):
         """
         アナライザクラスのコンストラクタ
         :param calibration: Calibrationインスタンス
+        :param scale: 解析解像度の倍率（REFERENCE_SIZE に対する比）
         """
         super().__init__(target=self.__call)
 
@@ -147,35 +459,89 @@ class Analyzer(threading.Thread):
 
         self.led_insert_pos = insert_led()
 
-        self.plot_size = (160, 320)
+        # 出力座標系 (REFERENCE_SIZE) での値．解析解像度での値は set_scale で計算
         self.grad_size = 100
         self.sd = 16
         self.over_scan = 60
-
-        self.filter_buffer = np.zeros((3, 121))
-
-        self.grad_img = None
+        self.touch_footprint = 10
+        self.blob_min_size = 100
+
+        self.scale = 1.0
+        self.plot_size = REFERENCE_SIZE
+        self.plot_grad_size = self.grad_size
+        self.plot_sd = self.sd
+        self.plot_over_scan = self.over_scan
+        self.plot_footprint = self.touch_footprint
+        self.plot_min_size = self.blob_min_size
+        self.reference_factor = (1.0, 1.0)     # 解析解像度から出力座標系への倍率 (x, y)
+
+        self.mode = self.MODE_FULL
+        self.filter_type = "none"
+        self.filter = None              # TemporalFilter (Noneならフィルタなし)
+        self.calibrated = np.zeros(121, np.float32)     # 正規化済みのセンサ値
+
+        # ベースライン補正
+        self.baseline_tracking = True
+        self.baseline_gate = 0.2                        # これを超える正規化値のセンサは更新しない
+        self.sensor_pos = sensor_positions(REFERENCE_SIZE).astype(np.float64)
+        self.covered = np.zeros(121, bool)
+
+        self.peak_finder = PeakFinder()
+
+        self.splatter = None
         self.plot_img = None
         self.disp_img = None
         self.disp2_img = None
         self.disp3_img = None
 
-        self.set_grad(self.grad_size, 16)
+        self.set_scale(scale)
 
-        self.time_stamp = 0.0
-        self.prev_time_stamp = -1.0
+        self.rate_meter = RateMeter()   # 解析の完了間隔
+
+        self.profiler = None            # StageProfiler (Noneなら計測しない)
+        self.frame_callback = None      # 1フレームの解析終了時に呼ばれる
+
+        self.frame_seq = 0              # 処理済みフレームのシーケンス番号
+        self.output_seq = 0             # 表示用画像の更新回数
+        self.dropped_frames = 0         # 処理が間に合わず読み飛ばしたフレーム数
+        self.idle_waits = 0             # 新しいフレームを待ってタイムアウトした回数
+        self.frame_data = np.zeros(121, np.uint16)      # 処理中のフレーム（受信側と共有しない）
 
     def __del__(self):
         self.stop()
 
     def stop(self):
         self.running = False
-        self.join()
+        if self.is_alive():
+            self.join()
 
     def set_grad(self, size, sd):
         self.grad_size = size
         self.sd = sd
-        self.grad_img = gauss2d(size, sd)
+        self.plot_grad_size = max(int(round(size * self.scale)), 2)
+        self.plot_sd = sd * self.scale
+        self.splatter = None
+
+    def set_scale(self, scale):
+        """
+        解析解像度の設定
+        描画・検出のパラメータは倍率に合わせて変換し，検出結果は出力座標系に戻してからトラッキングする
+        :param scale: REFERENCE_SIZE に対する倍率（0.5 なら 80x160 で解析）
+        :return: None
+        """
+        self.scale = scale
+        self.plot_size = (int(round(REFERENCE_SIZE[0] * scale)), int(round(REFERENCE_SIZE[1] * scale)))
+        self.plot_over_scan = int(round(self.over_scan * scale))
+        self.plot_footprint = max(int(round(self.touch_footprint * scale)), 1)
+        self.plot_min_size = self.blob_min_size * scale
+
+        # センサ間隔の比（整数の間隔で描画するため 1 / scale とは一致しない）
+        ref_xp, ref_yp = int(REFERENCE_SIZE[1] / 21), int(REFERENCE_SIZE[0] / 10)
+        xp, yp = int(self.plot_size[1] / 21), int(self.plot_size[0] / 10)
+        self.reference_factor = (ref_xp / xp, ref_yp / yp)
+
+        self.plot_img = None
+        self.set_grad(self.grad_size, self.sd)
 
     def set_curve(self, c_type):
         self.curve_type = c_type
@@ -187,36 +553,123 @@ class Analyzer(threading.Thread):
         self.gamma = gamma
 
     def get_rate(self):
-        return 1.0 / (self.time_stamp - self.prev_time_stamp)
+        return self.rate_meter.get_rate()
+
+    def get_rate_stat(self):
+        """
+        解析の完了間隔の統計
+        :return: RateMeter.get_stat() の辞書
+        """
+        return self.rate_meter.get_stat()
+
+    def set_frame_callback(self, callback):
+        """
+        フレームの解析終了時のコールバックを設定
+        callback(seq) はトラッカーのイベント送出と表示用画像の更新後に呼ばれる
+        """
+        self.frame_callback = callback
+
+    def set_mode(self, mode):
+        """
+        解析モードの切り替え
+        :param mode: MODE_FULL / MODE_TOUCH
+        :return: None
+        """
+        self.mode = mode
+
+    def set_filter(self, name):
+        """
+        時間方向フィルタの切り替え
+        :param name: filters.FILTERS のキー
+        :return: None
+        """
+        if name not in filters.FILTERS:
+            print('Error: Unknown filter "{}"'.format(name))
+            return
+        self.filter_type = name
+        self.filter = filters.create_filter(name)
+
+    def set_baseline_tracking(self, enable):
+        """
+        ベースライン補正の切り替え
+        :param enable: True で補正する
+        :return: None
+        """
+        self.baseline_tracking = enable
+
+    def covered_sensors(self, calc, touches, blobs):
+        """
+        タッチ・ブロブに覆われているセンサを求める
+        :param calc: 正規化済みのセンサ値
+        :param touches: タッチのリスト
+        :param blobs: ブロブのリスト
+        :return: (121,) bool
+        """
+        covered = self.covered
+        np.greater(calc, self.baseline_gate, out=covered)
+
+        pos = self.sensor_pos
+        if touches:
+            radius = self.sd * 2
+            points = np.array([touch.point for touch in touches], np.float64)
+            dist = np.sum((pos[:, None, :] - points[None, :, :]) ** 2, axis=2)
+            covered |= np.any(dist < radius * radius, axis=1)
+        for blob in blobs:
+            covered |= (pos[:, 0] >= blob.point1[0]) & (pos[:, 0] < blob.point2[0]) & \
+                       (pos[:, 1] >= blob.point1[1]) & (pos[:, 1] < blob.point2[1])
+        return covered
 
-    def update_filter(self, sensor_data):
+    def set_profiling(self, enable):
         """
-        移動平均フィルタ
-        :param sensor_data:
-        :return:
+        ステージ毎の処理時間計測の切り替え
+        :param enable: True で計測開始
+        :return: None
         """
-        self.filter_buffer = np.roll(self.filter_buffer, -1, axis=0)
-        self.filter_buffer[-1, :] = sensor_data
-        sensor_sum = self.filter_buffer.sum(axis=0) / (self.filter_buffer.shape[0] - 1)
-        return sensor_sum
+        if enable:
+            if self.profiler is None:
+                self.profiler = StageProfiler()
+        else:
+            self.profiler = None
+
+    def get_stage_stat(self):
+        """
+        :return: ステージ毎の処理時間の統計（計測していなければ空）
+        """
+        prof = self.profiler
+        if prof is None:
+            return {}
+        return prof.get_stat()
+
+    def get_frame_stat(self):
+        """
+        フレーム受け渡しの統計
+        :return: (処理済みシーケンス番号, 読み飛ばし数, 待ちのタイムアウト数)
+        """
+        return self.frame_seq, self.dropped_frames, self.idle_waits
 
     def __call(self):
         """
         処理ループ
         :return: None
         """
+        tm_frame = self.calibration.tm_frame
         while self.running:
-            self.__loop()
-            self.prev_time_stamp = self.time_stamp
-            self.time_stamp = time.time()
-            time.sleep(0.01)
+            seq, data = tm_frame.wait_frame(self.frame_seq, self.frame_data, timeout=0.1)
+            if data is None:
+                self.idle_waits += 1
+                continue
+            if self.frame_seq > 0:
+                self.dropped_frames += seq - self.frame_seq - 1
+            self.frame_seq = seq
+
+            self.__loop(data)
 
     def __clear_plot(self):
         """
         合成画像を初期化
         :return: None
         """
-        extra_px = self.over_scan * 2
+        extra_px = self.plot_over_scan * 2
         self.plot_img = np.zeros((self.plot_size[0] + extra_px, self.plot_size[1] + extra_px))
 
     def __plot(self, sensor_data):
@@ -225,29 +678,22 @@ class Analyzer(threading.Thread):
         :param sensor_data: センサ値
         :return: None
         """
-        self.__clear_plot()
-        sens_height, sens_width = sensor_data.shape[:2]
-        xp = int(self.plot_size[1] / (sens_width - 1))  # step x
-        yp = int(self.plot_size[0] / (sens_height - 1))  # step y
-        grad_h = int(self.grad_size / 2)
+        splatter = self.splatter
+        if splatter is None:
+            splatter = get_splatter(self.plot_size, sensor_data.shape[:2], self.plot_grad_size, self.plot_sd,
+                                     self.plot_over_scan)
+            self.splatter = splatter
+        if self.plot_img is None:
+            self.__clear_plot()
 
-        for hi in range(sens_height):
-            for wi in range(sens_width):
-                y = (hi * yp) + self.over_scan
-                x = (wi * xp) + self.over_scan
-                tmp = (self.grad_img * sensor_data[hi, wi])
-                self.plot_img[y - grad_h:y + grad_h, x - grad_h:x + grad_h] += tmp
+        splatter.render(sensor_data, out=self.plot_img)
 
-        self.plot_img[self.plot_img > 1.0] = 1.0
-
-    def __loop(self):
-        if not self.calibration.is_calibration_available():
-            return
-
-        calc = self.calibration.get_calibrated_data()
-        # calc = self.update_filter(tmp)
-
-        # tone curve
+    def tone_curve(self, calc):
+        """
+        トーンカーブの適用
+        :param calc: 正規化済みのセンサ値
+        :return: 変換後のセンサ値
+        """
         if self.curve_type == 1:
             calc = (calc ** self.gamma)
         if self.curve_type == 2:
@@ -255,33 +701,118 @@ class Analyzer(threading.Thread):
         if self.curve_type == 3:
             calc = (calc * 3)
         calc[calc > 1.0] = 1.0
+        return calc
 
-        intr(calc)
-
+    def to_grid(self, calc):
+        """
+        センサ値を千鳥格子状の (11, 22) 配列に並べる
+        :param calc: センサ値
+        :return: numpy配列
+        """
         calc = np.insert(calc, self.led_insert_pos, 0)
-        calc = np.reshape(calc, (11, 22))
-
-        self.__plot(calc)
+        return np.reshape(calc, (11, 22))
 
-        tmpx = self.over_scan + self.plot_size[0]
-        tmpy = self.over_scan + self.plot_size[1]
-
-        mask_blobs = detect_object(self.plot_img[self.over_scan:tmpx, self.over_scan:tmpy], 0.5)
-        touches = detect_touch(self.plot_img[self.over_scan:tmpx, self.over_scan:tmpy], mask_blobs, 0.05)
-        blobs = detect_object(self.plot_img[self.over_scan:tmpx, self.over_scan:tmpy], 0.1)
-
-        # touch handling
-        for touch in touches:
-            self.touch_tracker.update(touch)
-        self.touch_tracker.end_frame()
+    def plot(self, grid):
+        """
+        グラデーション画像を合成し，オーバースキャンを除いた領域を返す
+        :param grid: 千鳥格子状のセンサ値
+        :return: 合成画像
+        """
+        self.__plot(grid)
 
-        # blob handling
-        for blob in blobs:
-            self.blob_tracker.update(blob)
-        self.blob_tracker.end_frame()
+        tmpx = self.plot_over_scan + self.plot_size[0]
+        tmpy = self.plot_over_scan + self.plot_size[1]
+        return self.plot_img[self.plot_over_scan:tmpx, self.plot_over_scan:tmpy]
 
-        self.disp_img = self.plot_img[self.over_scan:tmpx, self.over_scan:tmpy] * 255
-        self.disp2_img = self.plot_img[self.over_scan:tmpx, self.over_scan:tmpy] * 255
-        self.disp3_img = cv2.resize((calc * 700).astype(np.uint8), (320, 160), interpolation=cv2.INTER_NEAREST)
-        self.disp4_img = cv2.resize((calc * 255).astype(np.uint8), (320, 160), interpolation=cv2.INTER_NEAREST)
+    def update_display(self, grid, img):
+        """
+        表示用画像の更新
+        :param grid: 千鳥格子状のセンサ値
+        :param img: 合成画像（タッチのみのモードでは None）
+        :return: None
+        """
+        if img is None:
+            img = cv2.resize(grid, (REFERENCE_SIZE[1], REFERENCE_SIZE[0]), interpolation=cv2.INTER_LINEAR)
+        elif img.shape != REFERENCE_SIZE:
+            img = cv2.resize(img, (REFERENCE_SIZE[1], REFERENCE_SIZE[0]), interpolation=cv2.INTER_LINEAR)
+        self.disp_img = img * 255
+        self.disp2_img = img * 255
+        self.disp3_img = cv2.resize((grid * 700).astype(np.uint8), (REFERENCE_SIZE[1], REFERENCE_SIZE[0]),
+                                    interpolation=cv2.INTER_NEAREST)
+        self.disp4_img = cv2.resize((grid * 255).astype(np.uint8), (REFERENCE_SIZE[1], REFERENCE_SIZE[0]),
+                                    interpolation=cv2.INTER_NEAREST)
+
+    def analyze(self, data):
+        """
+        1フレーム分の解析
+        profiler が設定されていればステージ毎の処理時間を記録する
+        :param data: センサフレーム
+        :return: None
+        """
+        prof = self.profiler
+        if prof is not None:
+            prof.begin()
+
+        calibrated = self.calibration.get_calibrated_data(data, out=self.calibrated)
+        if prof is not None:
+            prof.lap("calibration")
+
+        calc = calibrated
+        sensor_filter = self.filter
+        if sensor_filter is not None:
+            calc = sensor_filter.apply(calibrated)
+            if prof is not None:
+                prof.lap("filter")
+
+        calc = self.tone_curve(calc)
+        grid = self.to_grid(calc)
+        if prof is not None:
+            prof.lap("tone_curve")
+
+        if self.mode == self.MODE_TOUCH:
+            img = None
+            blobs = []
+            touches = detect_touch_grid(grid, 0.05, plot_size=REFERENCE_SIZE)
+            if prof is not None:
+                prof.lap("detect_touch")
+        else:
+            img = self.plot(grid)
+            if prof is not None:
+                prof.lap("plot")
+
+            mask_blobs, blobs = detect_objects(img, (0.5, 0.1), self.plot_min_size)
+            if prof is not None:
+                prof.lap("detect_objects")
+            touches = self.peak_finder.find(img, mask_blobs, 0.05, self.plot_footprint)
+            if self.scale != 1.0:
+                touches, blobs = to_reference(touches, blobs, self.reference_factor)
+            if prof is not None:
+                prof.lap("detect_touch")
+
+        if self.baseline_tracking:
+            self.calibration.update_baseline(data, self.covered_sensors(calibrated, touches, blobs))
+            if prof is not None:
+                prof.lap("baseline")
+
+        # touch / blob handling (OSC送信を含む)
+        self.touch_tracker.update_frame(touches)
+        self.blob_tracker.update_frame(blobs)
+        if prof is not None:
+            prof.lap("tracking")
+
+        self.update_display(grid, img)
+        self.output_seq += 1
+        self.rate_meter.tick()
+        if prof is not None:
+            prof.lap("display")
+
+        if self.frame_callback is not None:
+            self.frame_callback(self.frame_seq)
+        if prof is not None:
+            prof.end()
+
+    def __loop(self, data):
+        if not self.calibration.is_calibration_available():
+            return
 
+        self.analyze(data)
@@ -1,38 +1,165 @@
-import time
+import threading
 import numpy as np
 
 
+class FrameAccumulator:
+    """
+    TmFrame の新しいフレームを count 枚集め，センサ毎の最小・最大・平均・分散を逐次計算する
+    フレームは受信スレッドで処理されるため，呼び出し側をブロックしない
+    """
+
+    def __init__(self, tm_frame, count, callback=None):
+        """
+        :param tm_frame: TmFrameインスタンス
+        :param count: 集めるフレーム数
+        :param callback: 完了時に callback(accumulator) が受信スレッドから呼ばれる
+        """
+        self.tm_frame = tm_frame
+        self.count = count
+        self.callback = callback
+
+        self.n = 0
+        self.min = np.full(121, np.inf)
+        self.max = np.full(121, -np.inf)
+        self.mean = np.zeros(121)
+        self.m2 = np.zeros(121)
+        self.delta = np.zeros(121)
+
+        self.done = threading.Event()
+
+    def start(self):
+        self.tm_frame.add_listener(self.on_frame)
+
+    def cancel(self):
+        self.tm_frame.remove_listener(self.on_frame)
+
+    def on_frame(self, seq, frame, time_stamp):
+        if self.done.is_set():
+            return
+
+        # Welford法
+        self.n += 1
+        np.minimum(self.min, frame, out=self.min)
+        np.maximum(self.max, frame, out=self.max)
+        np.subtract(frame, self.mean, out=self.delta)
+        self.mean += self.delta / self.n
+        self.m2 += self.delta * (frame - self.mean)
+
+        if self.n >= self.count:
+            self.tm_frame.remove_listener(self.on_frame)
+            self.done.set()
+            if self.callback is not None:
+                self.callback(self)
+
+    @property
+    def var(self):
+        if self.n < 2:
+            return np.zeros(121)
+        return self.m2 / (self.n - 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+
 class Calibration:
-    def __init__(self, tm_frame, test_mode=False):
+    def __init__(self, tm_frame, test_mode=False, path="../cal_data.npz"):
         self.tm_frame = tm_frame
+        self.path = path
 
         self.cal_min = None
         self.cal_max = None
         self.range = None
 
-        self.cal_min_4led = np.zeros((121, 4), dtype=np.uint16)
-        self.cal_max_4led = np.zeros((121, 4), dtype=np.uint16)
+        # 正規化用（キャリブレーション変更時に計算）
+        self.offset = None          # cal_min (float32)
+        self.inv_range = None       # 1 / range (float32)，範囲のないセンサは0
+
+        # ベースライン（何も置いていない状態のセンサ値）の追従
+        self.baseline_ref = None    # 下限キャリブレーション時の平均値
+        self.baseline = None        # 現在の推定値
+        self.margin = None          # cal_min - baseline_ref
+        self.drift_alpha = 0.002    # 1フレーム毎の追従率
+        self.drift_delta = np.zeros(121, np.float32)
 
-        self.sample_count = 10
+        self.sample_count = 30          # キャリブレーションに使うフレーム数
+        self.noise_k = 3.0              # 下限値 = 平均 + noise_k * 標準偏差
+        self.accumulator = None         # 実行中の FrameAccumulator
+        self.stat = {}                  # 最後のキャリブレーションの統計
 
-    def get_calibrated_data(self):
+    def get_calibrated_data(self, data=None, out=None):
+        """
+        センサ値を 0.0 - 1.0 に正規化（入力は変更しない）
+        :param data: センサ値．None なら最新フレーム
+        :param out: 出力先の float32 配列 (121,)．None なら新しく確保
+        :return: 正規化済みのセンサ値
+        """
         if not self.is_calibration_available():
             return None
 
-        data = self.tm_frame.n_array
+        if data is None:
+            data = self.tm_frame.n_array
+        if out is None:
+            out = np.empty(data.shape, np.float32)
+
+        np.subtract(data, self.offset, out=out)
+        np.multiply(out, self.inv_range, out=out)
+        np.clip(out, 0.0, 1.0, out=out)
+
+        return out
+
+    def __prepare(self):
+        """
+        正規化用の係数を計算
+        """
+        span = self.cal_max.astype(np.float32) - self.cal_min.astype(np.float32)
+        inv_range = np.zeros(span.shape, np.float32)
+        np.divide(1.0, span, out=inv_range, where=span > 0)
+
+        offset = self.cal_min.astype(np.float32)
+        baseline = offset.copy() if self.baseline_ref is None else self.baseline_ref.astype(np.float32)
 
-        # replace out-of-range values (lower)
-        data[data < self.cal_min] = self.cal_min[data < self.cal_min]
-        offset = data - self.cal_min
+        self.margin = offset - baseline
+        self.baseline = baseline
+        self.offset = offset
+        self.inv_range = inv_range
 
-        # replace out-of-range values (upper)
-        offset[offset > self.range] = self.range[offset > self.range]
+    def update_baseline(self, data, covered):
+        """
+        覆われていないセンサのベースラインを指数移動平均で追従させ，下限値を補正する
+        :param data: センサ値
+        :param covered: タッチ・ブロブに覆われているセンサ (121,) bool
+        :return: None
+        """
+        if self.baseline is None:
+            return
+
+        delta = self.drift_delta
+        np.subtract(data, self.baseline, out=delta)
+        delta *= self.drift_alpha
+        np.copyto(delta, 0.0, where=covered)
+        self.baseline += delta
+        np.add(self.baseline, self.margin, out=self.offset)
 
-        # normalize
-        calc = (offset / self.range)
-        calc[calc > 1.0] = 1.0
+    def get_drift(self):
+        """
+        キャリブレーション時からのベースラインの変化量（補正後の下限値 - cal_min）
+        """
+        if self.baseline is None:
+            return None
+        return self.offset - self.cal_min
 
-        return calc
+    def set_data(self, cal_min, cal_max):
+        """
+        キャリブレーション値の設定
+        :param cal_min: 下限値
+        :param cal_max: 上限値
+        :return: None
+        """
+        self.cal_min = cal_min
+        self.cal_max = cal_max
+        self.range = cal_max - cal_min
+        self.__prepare()
 
     def get_range(self):
         return self.range
@@ -42,50 +169,64 @@ class Calibration:
             return False
         return True
 
-    def __cal_data(self, src):
-        tmp = np.zeros((121, self.sample_count), dtype=np.uint16)
-        for i in range(self.sample_count):
-            tmp[:, i] = src
-            time.sleep(0.1)
-        return tmp.max(axis=1, initial=0) - 50
-
-    def calibration_lower(self):
+    def __start(self, name, finish):
+        """
+        バックグラウンドでフレームを集める
+        :param name: "lower" / "upper"
+        :param finish: 完了時に統計を受け取る関数
+        :return: 開始できたか
+        """
         if self.tm_frame.n_array is None:
             print('Error: No Sensor data available (Check the connection to the Raspberry Pi)')
-            return
-        self.cal_min = self.__cal_data(self.tm_frame.n_array)
-        print(self.cal_min)
-
-        if self.tm_frame.n_array_4led is not None:
-            print('Info: 4LED Mode')
-            self.cal_min_4led[:, 0] = self.__cal_data(self.tm_frame.n_array_4led[:, 0])
-            print('Info: cal n')
-            self.cal_min_4led[:, 1] = self.__cal_data(self.tm_frame.n_array_4led[:, 1])
-            print('Info: cal w')
-            self.cal_min_4led[:, 2] = self.__cal_data(self.tm_frame.n_array_4led[:, 2])
-            print('Info: cal e')
-            self.cal_min_4led[:, 3] = self.__cal_data(self.tm_frame.n_array_4led[:, 3])
-            print('Info: cal s')
+            return False
+        if self.accumulator is not None and not self.accumulator.done.is_set():
+            print('Error: Calibration is running')
+            return False
+
+        def on_finish(acc):
+            self.stat[name] = {"min": acc.min, "max": acc.max, "mean": acc.mean, "std": acc.std}
+            finish(acc)
+            print('Info: {} calibration finished ({} frames)'.format(name.capitalize(), acc.n))
+
+        self.accumulator = FrameAccumulator(self.tm_frame, self.sample_count, on_finish)
+        self.accumulator.start()
+        print('Info: {} calibration started'.format(name.capitalize()))
+        return True
+
+    def calibration_lower(self):
+        """
+        下限値（何も置いていない状態）のキャリブレーションを開始
+        ノイズが0に正規化されるよう，平均 + noise_k * 標準偏差 を下限値とする
+        """
+        def finish(acc):
+            lower = acc.mean + self.noise_k * acc.std
+            self.baseline_ref = acc.mean.astype(np.float32)
+            self.cal_min = np.clip(np.round(lower), 0, 65535).astype(np.uint16)
+            print(self.cal_min)
+            if self.cal_max is not None:
+                self.calc_range()
+
+        return self.__start("lower", finish)
 
     def calibration_upper(self):
-        if self.tm_frame.n_array is None:
-            print('Error: No Sensor data available (Check the connection to the Raspberry Pi)')
-            return
-        self.cal_max = self.__cal_data(self.tm_frame.n_array)
-        print(self.cal_max)
-
-        if self.tm_frame.n_array_4led is not None:
-            print('Info: 4LED Mode')
-            self.cal_max_4led[:, 0] = self.__cal_data(self.tm_frame.n_array_4led[:, 0])
-            print('Info: cal n')
-            self.cal_max_4led[:, 1] = self.__cal_data(self.tm_frame.n_array_4led[:, 1])
-            print('Info: cal w')
-            self.cal_max_4led[:, 2] = self.__cal_data(self.tm_frame.n_array_4led[:, 2])
-            print('Info: cal e')
-            self.cal_max_4led[:, 3] = self.__cal_data(self.tm_frame.n_array_4led[:, 3])
-            print('Info: cal s')
-
-        self.calc_range()
+        """
+        上限値（センサを覆った状態）のキャリブレーションを開始
+        """
+        def finish(acc):
+            self.cal_max = np.clip(np.round(acc.mean), 0, 65535).astype(np.uint16)
+            print(self.cal_max)
+            self.calc_range()
+
+        return self.__start("upper", finish)
+
+    def wait(self, timeout=None):
+        """
+        実行中のキャリブレーションの完了を待つ
+        :return: 完了したか
+        """
+        if self.accumulator is None:
+            return True
+        return self.accumulator.done.wait(timeout)
 
     def calc_range(self):
         if self.cal_min is None:
@@ -97,19 +238,18 @@ class Calibration:
 
         tmp = self.cal_max - self.cal_min
 
-        # error = np.where(tmp == 0)  # ERROR DETECTOR
-        # if error.shape[0] > 0:
-        #     print('Error: sensor ')
-        #     print(error)
-        #     return
+        dead = np.flatnonzero(self.cal_max <= self.cal_min)
+        if dead.shape[0] > 0:
+            print('Info: No range on sensor {}'.format(dead.tolist()))
 
         self.range = tmp
+        self.__prepare()
         print(self.range)
 
     def save_data(self):
         if self.is_calibration_available():
-            np.savez("../cal_data", self.cal_min, self.cal_max, self.range)
-            print('Info: Calibration data is saved as "cal_data.npz"')
+            np.savez(self.path, self.cal_min, self.cal_max, self.range, self.margin)
+            print('Info: Calibration data is saved as "{}"'.format(self.path))
         else:
             print('Error: Calibration required')
 
@@ -117,7 +257,7 @@ class Calibration:
         data = None
 
         try:
-            data = np.load("../cal_data.npz")
+            data = np.load(self.path)
         except FileNotFoundError:
             print('Calibration file not found')
             return
@@ -127,3 +267,7 @@ class Calibration:
         self.cal_min = data['arr_0']
         self.cal_max = data['arr_1']
         self.range = data['arr_2']
+        self.baseline_ref = None
+        if 'arr_3' in data.files:
+            self.baseline_ref = self.cal_min - data['arr_3']
+        self.__prepare()
@@ -0,0 +1,125 @@
+import os
+import time
+import struct
+import threading
+
+import numpy as np
+
+
+MAGIC = b'TMCAP\x00\x00\x00'
+VERSION = 1
+PIXELS = 121
+
+# magic, version, pixels, record size, reserved
+HEADER = struct.Struct('<8sIII12x')
+
+RECORD_DTYPE = np.dtype([
+    ('seq', '<u8'),                 # TmFrame のシーケンス番号
+    ('time', '<f8'),                # 受信時刻 (time.time)
+    ('monotonic', '<f8'),           # 再生タイミング用の単調増加時刻 (time.perf_counter)
+    ('data', '<u2', (PIXELS,)),     # センサ値
+])
+
+
+def read_header(f):
+    raw = f.read(HEADER.size)
+    if len(raw) < HEADER.size:
+        raise ValueError("capture header is truncated")
+    magic, version, pixels, record_size = HEADER.unpack(raw)
+    if magic != MAGIC:
+        raise ValueError("not a TouchMatrix capture file")
+    if version != VERSION or pixels != PIXELS or record_size != RECORD_DTYPE.itemsize:
+        raise ValueError("unsupported capture format (version {}, {} pixels)".format(version, pixels))
+
+
+class FrameRecorder:
+    """
+    確定したTmFrameを追記型のバイナリファイルに記録する
+    既存のファイルに追記する場合は，monotonic が前回の記録から1フレーム間隔で続くようにずらす
+    （perf_counter の原点はプロセス毎に異なるため）
+    書き込み途中で終了したファイルは末尾の不完全なレコードを切り詰めてから追記する
+    レコード毎に flush するため，異常終了で失われるのは書き込み中の1レコードのみ
+    使い方: tm_frame.add_listener(recorder.on_frame)
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.record = np.zeros(1, RECORD_DTYPE)
+        self.count = 0
+        self.resume = None          # 追記時，最初のレコードの monotonic
+        self.time_offset = 0.0      # perf_counter から monotonic への差
+
+        exists = os.path.exists(path) and os.path.getsize(path) > 0
+        if exists:
+            capture = FrameCapture(path)
+            records = capture.records
+            count = len(records)
+            if count > 0:
+                interval = records['monotonic'][-1] - records['monotonic'][-2] if count > 1 else 0.0
+                self.resume = float(records['monotonic'][-1] + max(interval, 0.0))
+            del records, capture
+            os.truncate(path, HEADER.size + count * RECORD_DTYPE.itemsize)
+
+        self.file = open(path, 'ab')
+        if not exists:
+            self.file.write(HEADER.pack(MAGIC, VERSION, PIXELS, RECORD_DTYPE.itemsize))
+
+    def on_frame(self, seq, frame, time_stamp):
+        """
+        TmFrameのリスナー
+        """
+        with self.lock:
+            if self.file is None:
+                return
+            self.record['seq'] = seq
+            self.record['time'] = time_stamp
+            now = time.perf_counter()
+            if self.resume is not None:
+                self.time_offset = self.resume - now
+                self.resume = None
+            self.record['monotonic'] = now + self.time_offset
+            self.record['data'] = frame
+            self.file.write(self.record.tobytes())
+            self.file.flush()
+            self.count += 1
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class FrameCapture:
+    """
+    記録ファイルをメモリマップで読み込む
+    records は RECORD_DTYPE の構造化配列
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(path, 'rb') as f:
+            read_header(f)
+
+        # 書き込み途中の末尾レコードは無視する
+        count = (os.path.getsize(path) - HEADER.size) // RECORD_DTYPE.itemsize
+        if count > 0:
+            self.records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER.size, shape=(count,))
+        else:
+            self.records = np.zeros(0, RECORD_DTYPE)
+
+    def __len__(self):
+        return len(self.records)
+
+    def get_frames(self):
+        """
+        :return: (フレーム数, 121) のセンサ値
+        """
+        return self.records['data']
+
+    def get_duration(self):
+        if len(self.records) < 2:
+            return 0.0
+        return float(self.records['monotonic'][-1] - self.records['monotonic'][0])
@@ -1,12 +1,17 @@
 import threading
+import collections
 
 import time
 
 import numpy as np
 
 from classes.tracker import Touch, Blob, ObjTracker
+from classes.capture import FrameCapture
+from classes.profiler import RateMeter
 
 from pythonosc import udp_client
+from pythonosc import osc_bundle_builder
+from pythonosc import osc_message_builder
 from pythonosc import dispatcher
 from pythonosc import osc_server
 
@@ -14,30 +19,290 @@ import serial
 
 
 class TmFrame:
-
-    def __init__(self):
+    """
+    センサフレームの受け渡し用バッファ
+    確定したフレームはダブルバッファに書き込まれ，シーケンス番号で識別する
+    受信したピクセルを記録し，欠けのあるフレームの扱いを policy で選択する
+        POLICY_PUBLISH: 公開する（欠けたピクセルは直前に公開したフレームの値のまま．get_stale() で判別できる）
+        POLICY_HOLD: 公開しない
+    """
+
+    POLICY_PUBLISH = 0
+    POLICY_HOLD = 1
+    POLICIES = {"publish": POLICY_PUBLISH, "hold": POLICY_HOLD}
+
+    def __init__(self, policy=POLICY_PUBLISH):
         self.frame_buffer = np.zeros(121, np.uint16)
+        self.received = np.zeros(121, bool)            # 現在のフレームで受信したピクセル
+        self.missing = np.zeros(121, bool)
         self.available = False
-        self.n_array = None
+        self.policy = policy
+        self.complete = True                            # 最後に確定したフレームに欠けがなかったか
+
+        # 入力の異常のカウンタ
+        self.incomplete_frames = 0      # 欠けのあったフレーム数
+        self.held_frames = 0            # POLICY_HOLD で公開しなかったフレーム数
+        self.out_of_range = 0           # 範囲外のピクセル番号の数
+        self.framing_errors = 0         # SLIPの不正なパケットの数
+
+        self.frames = np.zeros((2, 121), np.uint16)    # ダブルバッファ
+        self.views = [self.frames[i].view() for i in range(2)]     # 読み出し用の書き込み不可のビュー
+        for view in self.views:
+            view.setflags(write=False)
+        self.stale = np.zeros((2, 121), bool)          # 各フレームで受信しなかったピクセル
+        self.stale_views = [self.stale[i].view() for i in range(2)]
+        for view in self.stale_views:
+            view.setflags(write=False)
+        self.front = 0
+        self.seq = 0                                    # 確定したフレーム数
+        self.condition = threading.Condition()
 
         self.time_stamp = 0.0
-        self.prev_time_stamp = -1.0
+        self.rate_meter = RateMeter()   # フレームの確定間隔
+
+        self.listeners = []
+
+    @property
+    def n_array(self):
+        """
+        最新の確定フレーム（未受信ならNone）
+        書き込み不可のビューで，2フレーム後に上書きされる
+        """
+        if self.seq == 0:
+            return None
+        return self.views[self.front]
+
+    def set_policy(self, policy):
+        """
+        欠けのあるフレームの扱いの設定
+        :param policy: POLICY_PUBLISH / POLICY_HOLD
+        :return: None
+        """
+        self.policy = policy
 
     def add_pixel(self, index, value):
-        if index >= 121:
+        if not 0 <= index < 121:
+            self.out_of_range += 1
             return
         self.frame_buffer[index] = value
+        self.received[index] = True
+
+    def add_pixels(self, indices, values):
+        """
+        複数のピクセルをまとめて書き込む
+        :param indices: ピクセル番号の配列
+        :param values: 値の配列
+        :return: None
+        """
+        valid = (indices >= 0) & (indices < 121)
+        if not valid.all():
+            self.out_of_range += int(valid.shape[0] - np.count_nonzero(valid))
+            indices = indices[valid]
+            values = values[valid]
+        self.frame_buffer[indices] = values
+        self.received[indices] = True
+
+    def set_frame(self, data):
+        """
+        フレーム全体を書き込んで確定する
+        :param data: 121個のセンサ値
+        :return: None
+        """
+        np.copyto(self.frame_buffer, data, casting='unsafe')
+        self.received[:] = True
+        self.finalize()
+
+    def report_framing_errors(self, count):
+        """
+        受信側で検出した不正なパケットの数を加算
+        """
+        self.framing_errors += count
+
+    def get_integrity(self):
+        """
+        入力の異常のカウンタ
+        :return: 辞書
+        """
+        return {
+            "frames": self.seq,
+            "incomplete_frames": self.incomplete_frames,
+            "held_frames": self.held_frames,
+            "out_of_range": self.out_of_range,
+            "framing_errors": self.framing_errors,
+            "input_errors": self.out_of_range + self.framing_errors,
+        }
+
+    def add_listener(self, callback):
+        """
+        フレーム確定時のコールバックを登録
+        callback(seq, frame, time_stamp) は受信スレッドから呼ばれる
+        """
+        self.listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self.listeners:
+            self.listeners.remove(callback)
 
     def get_rate(self):
-        return 1
-        # return 1.0 / (self.time_stamp - self.prev_time_stamp)
+        return self.rate_meter.get_rate()
+
+    def get_rate_stat(self):
+        """
+        フレームの確定間隔の統計
+        :return: RateMeter.get_stat() の辞書
+        """
+        return self.rate_meter.get_stat()
+
+    def get_stale(self):
+        """
+        最新の確定フレームで受信しなかった（直前のフレームの値のままの）ピクセル
+        :return: (シーケンス番号, (121,) bool の書き込み不可のビュー)．未受信なら (0, None)
+        """
+        with self.condition:
+            if self.seq == 0:
+                return 0, None
+            return self.seq, self.stale_views[self.front]
+
+    def get_frame(self):
+        """
+        最新の確定フレームを取得
+        :return: (シーケンス番号, フレーム)
+        """
+        with self.condition:
+            return self.seq, self.n_array
+
+    def wait_frame(self, last_seq, out, timeout=None):
+        """
+        last_seq より新しいフレームが確定するまで待ち，out にコピーする
+        コピーはロック中に行うため，処理中に受信側が同じスロットを上書きしても out は変わらない
+        :param last_seq: 処理済みのシーケンス番号
+        :param out: コピー先のバッファ (121,)
+        :param timeout: タイムアウト [s]
+        :return: (シーケンス番号, out)．タイムアウト時は (last_seq, None)
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.seq != last_seq, timeout):
+                return last_seq, None
+            np.copyto(out, self.frames[self.front])
+            return self.seq, out
 
     def finalize(self):
-        self.available = True
-        self.n_array = np.array(self.frame_buffer, np.uint16)
+        np.logical_not(self.received, out=self.missing)
+        self.complete = not self.missing.any()
+        self.received[:] = False
+        if not self.complete:
+            self.incomplete_frames += 1
+            if self.policy == self.POLICY_HOLD:
+                # 受信途中の値が次のフレームに残らないよう，公開済みの値に戻す
+                np.copyto(self.frame_buffer, self.frames[self.front], where=self.missing)
+                self.held_frames += 1
+                return
+
+        # 欠けたピクセルは frame_buffer に直前に公開した値が残っている
+        back = 1 - self.front
+        self.frames[back] = self.frame_buffer
+        self.stale[back] = self.missing
+
+        with self.condition:
+            self.front = back
+            self.seq += 1
+            self.available = True
+
+            self.time_stamp = time.time()
+            self.condition.notify_all()
+        self.rate_meter.tick()
+
+        for callback in tuple(self.listeners):
+            callback(self.seq, self.views[back], self.time_stamp)
+
+
+class SlipDecoder:
+    """
+    SLIPでエンコードされたピクセルパケットの一括デコーダ
+    パケットは 0xC0 の後に続く4byte (index, reserved, value_h, value_l)
+    """
+
+    END = 0xC0
+    ESC = 0xDB
+    ESC_END = 0xDC
+    ESC_ESC = 0xDD
 
-        self.prev_time_stamp = self.time_stamp
-        self.time_stamp = time.time()
+    PACKET_SIZE = 4
+    MAX_CARRY = 64
+
+    def __init__(self):
+        self.carry = b''
+        self.framing_errors = 0     # 長さが不正なパケット・不正なエスケープ・あふれた持ち越しの数
+
+    def reset(self):
+        self.carry = b''
+
+    def decode(self, chunk):
+        """
+        受信したバイト列をまとめてデコード
+        :param chunk: 受信データ
+        :return: (ピクセル番号の配列, 値の配列)
+        """
+        data = self.carry + chunk
+        self.carry = b''
+
+        raw = np.frombuffer(data, np.uint8)
+        is_end = raw == self.END
+        if not is_end.any():
+            # パケットの途中のみ．区切りが来るまで保持
+            if len(data) <= self.MAX_CARRY:
+                self.carry = data
+            else:
+                self.framing_errors += 1
+            return self.__empty()
+
+        seg_id = np.cumsum(is_end)          # 0 は最初の区切り以前（同期前のゴミ）
+        is_esc = raw == self.ESC
+        escaped = np.zeros_like(is_esc)
+        escaped[1:] = is_esc[:-1]
+
+        values = raw.copy()
+        values[escaped & (raw == self.ESC_END)] = self.END
+        values[escaped & (raw == self.ESC_ESC)] = self.ESC
+        invalid_esc = escaped & (raw != self.ESC_END) & (raw != self.ESC_ESC)
+        keep = ~(is_end | is_esc | invalid_esc)
+
+        payload = values[keep]
+        payload_seg = seg_id[keep]
+
+        n_seg = int(seg_id[-1]) + 1
+        counts = np.bincount(payload_seg, minlength=n_seg)
+        starts = np.zeros(n_seg, np.int64)
+        np.cumsum(counts[:-1], out=starts[1:])
+
+        # 末尾のパケットが未完成なら次回の受信に持ち越し
+        last_end = int(np.flatnonzero(is_end)[-1])
+        carried = counts[-1] < self.PACKET_SIZE
+        if carried:
+            self.carry = data[last_end:]
+            counts[-1] = 0
+        counts[0] = 0
+
+        # 長さが不正，または不正なエスケープを含むパケットを数える
+        bad = (counts > 0) & (counts != self.PACKET_SIZE)
+        bad[seg_id[invalid_esc]] = True
+        bad[0] = False
+        if carried:
+            bad[-1] = False
+        self.framing_errors += int(np.count_nonzero(bad))
+
+        complete = np.flatnonzero(counts >= self.PACKET_SIZE)
+        if complete.size == 0:
+            return self.__empty()
+
+        packets = payload[starts[complete, None] + np.arange(self.PACKET_SIZE)]
+        index = packets[:, 0].astype(np.int64)
+        value = (packets[:, 2].astype(np.uint16) << 8) | packets[:, 3]
+        return index, value
+
+    @staticmethod
+    def __empty():
+        return np.zeros(0, np.int64), np.zeros(0, np.uint16)
 
 
 class SerialServer:
@@ -48,70 +313,199 @@ class SerialServer:
         self.buffer = tm_frame
         self.ip = dev
 
-        self.read_data = []
-        self.prev_data = 0
-        self.reading = False
-        self.esc = False
+        self.decoder = SlipDecoder()
+        self.thread = None
+
+        # 受信量の累計と，レート計算用の直近 stat_window 秒のスナップショット
+        self.received_bytes = 0
+        self.received_frames = 0
+        self.stat_window = 2.0
+        self.stat_samples = collections.deque()    # (time.monotonic(), 受信バイト数, 受信フレーム数)
+        self.stat_lock = threading.Lock()
 
     def set_addr(self, ip, port):
         self.dev = ip
         self.baud = port
 
-    def set_buffer(self):
-        num = int.from_bytes(self.read_data[0], 'big')
-        value = (int.from_bytes(self.read_data[2], 'big') << 8) | int.from_bytes(self.read_data[3], 'big')
-
-        self.buffer.add_pixel(num, value)
-        if num == 120:
+    def set_buffer(self, index, value):
+        """
+        デコード済みのピクセル列をフレームバッファへ書き込む
+        index 120 を区切りとしてフレームを確定する
+        :param index: ピクセル番号の配列
+        :param value: 値の配列
+        :return: None
+        """
+        ends = np.flatnonzero(index == 120) + 1
+        begin = 0
+        for end in ends:
+            self.buffer.add_pixels(index[begin:end], value[begin:end])
             self.buffer.finalize()
-
-        self.read_data.clear()
-
-    def decode_slip(self, char):
-        # detect end packet
-        if char == b'\xc0':
-            self.reading = True
-            return
-
-        if self.reading:
-            # detect escape packet
-            if char == b'\xdb':
-                self.esc = True
+            self.received_frames += 1
+            begin = end
+        if begin < len(index):
+            self.buffer.add_pixels(index[begin:], value[begin:])
+
+    def decode(self, chunk):
+        """
+        受信データをデコードしてフレームバッファへ書き込む
+        :param chunk: 受信データ
+        :return: None
+        """
+        errors = self.decoder.framing_errors
+        index, value = self.decoder.decode(chunk)
+        if self.decoder.framing_errors != errors:
+            self.buffer.report_framing_errors(self.decoder.framing_errors - errors)
+        if len(index) > 0:
+            self.set_buffer(index, value)
+        self.__sample()
+
+    def __sample(self):
+        """
+        受信量のスナップショットを 0.1 秒毎に記録（受信スレッドから呼ぶ）
+        """
+        now = time.monotonic()
+        with self.stat_lock:
+            samples = self.stat_samples
+            if samples and now - samples[-1][0] < 0.1:
                 return
-
-            # if escaping
-            if self.esc:
-                if char == b'\xdc':
-                    self.read_data.append(b'\xc0')
-                if char == b'\xdd':
-                    self.read_data.append(b'\xdb')
-                self.esc = False
-            else:
-                self.read_data.append(char)
-
-            if len(self.read_data) == 4:
-                self.set_buffer()
-                self.reading = False
+            samples.append((now, self.received_bytes, self.received_frames))
+            while now - samples[0][0] > self.stat_window:
+                samples.popleft()
+
+    def get_stat(self):
+        """
+        直近 stat_window 秒の受信レート
+        カウンタを変更しないため，複数の呼び出し元から読んでも互いに影響しない
+        :return: (bytes/sec, frames/sec)
+        """
+        now = time.monotonic()
+        with self.stat_lock:
+            oldest = next((s for s in self.stat_samples if now - s[0] <= self.stat_window), None)
+        if oldest is None:
+            return 0.0, 0.0
+        t, received_bytes, received_frames = oldest
+        elapsed = now - t
+        if elapsed <= 0.0:
+            return 0.0, 0.0
+        return (self.received_bytes - received_bytes) / elapsed, (self.received_frames - received_frames) / elapsed
 
     def read(self):
+        self.decoder.reset()
         with serial.Serial(self.dev, self.baud, timeout=1) as ser:
             while self.running:
-                char = ser.read()
-                self.decode_slip(char)
+                # 受信済みのデータをまとめて読み込む（最低1byteはタイムアウトまで待つ）
+                chunk = ser.read(ser.in_waiting or 1)
+                if not chunk:
+                    continue
+                self.received_bytes += len(chunk)
+                self.decode(chunk)
 
     def start_server(self):
         print("Starting Server")
         print("Serving on {}".format(self.dev))
-        thread = threading.Thread(target=self.read)
-        thread.start()
         self.running = True
+        self.thread = threading.Thread(target=self.read)
+        self.thread.start()
+
+    def stop(self):
+        if self.running:
+            self.running = False
+            self.thread.join()
+
+
+class ReplayServer:
+    """
+    記録したセンサフレームを再生する（SerialServerの代替）
+    speed: 1.0で記録時と同じタイミング，2.0で倍速，0で待ち時間なし
+    """
+
+    def __init__(self, tm_frame, path="capture.tmcap", speed=1.0, loop=False):
+        self.path = path
+        self.speed = speed
+        self.loop = loop
+        self.running = False
+        self.buffer = tm_frame
+        self.ip = path
+
+        self.thread = None
+
+    def set_addr(self, ip, port):
+        # 他のサーバと同じ呼び出し方に合わせる（port は使わない）
+        self.path = ip
+        self.ip = ip
+
+    def replay(self):
+        try:
+            capture = FrameCapture(self.path)
+        except (OSError, ValueError) as e:
+            print("Error : {}".format(e))
+            self.running = False
+            return
+
+        records = capture.records
+        while self.running and len(records) > 0:
+            start = time.perf_counter()
+            origin = records['monotonic'][0]
+            for record in records:
+                if not self.running:
+                    break
+                if self.speed > 0:
+                    wait = start + (record['monotonic'] - origin) / self.speed - time.perf_counter()
+                    if wait > 0:
+                        time.sleep(wait)
+                self.buffer.set_frame(record['data'])
+
+            if not self.loop:
+                break
+
+        print("Replay finished")
+        self.running = False
+
+    def start_server(self):
+        print("Starting Server")
+        print("Replaying {}".format(self.path))
+        self.running = True
+        self.thread = threading.Thread(target=self.replay)
+        self.thread.start()
 
     def stop(self):
         if self.running:
             self.running = False
+            self.thread.join()
+
+
+def create_server(tm_frame, param, runtime=None):
+    """
+    設定に応じたセンサ入力を生成
+    :param tm_frame: TmFrame
+    :param param: settings.json の "connection"
+    :param runtime: aio.IoRuntime（指定すればシリアル・OSC受信をイベントループで行う）
+    :return: SerialServer, OSCServer または ReplayServer
+    """
+    if "replay" in param:
+        return ReplayServer(tm_frame, param["replay"], speed=param.get("replay_speed", 1.0))
+    if "sensor_osc" in param:
+        ip, port = param["sensor_osc"]
+        if runtime is not None:
+            from classes.aio import AsyncOSCServer
+            return AsyncOSCServer(tm_frame, runtime, ip, port)
+        return OSCServer(tm_frame, ip, port)
+    if runtime is not None:
+        from classes.aio import AsyncSerialServer
+        return AsyncSerialServer(tm_frame, runtime, param["sensor_addr"], baud=403200)
+    return SerialServer(tm_frame, param["sensor_addr"], baud=403200)
 
 
 class OSCServer:
+    """
+    OSCでセンサ値を受信する
+    /sensor_value index value : 1ピクセル毎（index 120 でフレームを確定）
+    /sensor_frame blob [counter] : 1フレーム分 (121 x big-endian uint16 = 242byte) を1メッセージで
+    """
+
+    FRAME_DTYPE = np.dtype('>u2')
+    FRAME_BYTES = 121 * FRAME_DTYPE.itemsize
+
     def __init__(self, tm_frame, ip="127.0.0.1", port=7000):
         self.ip = ip
         self.port = port
@@ -120,9 +514,14 @@ class OSCServer:
 
         self.running = False
 
+        self.frame_counter = None   # 最後に受信した /sensor_frame のカウンタ
+        self.lost_frames = 0        # カウンタの飛びから求めた欠落フレーム数
+        self.invalid_frames = 0     # サイズが不正な /sensor_frame の数
+
         # listen to addresses and print changes in values
         self.dispatcher = dispatcher.Dispatcher()
         self.dispatcher.map("/sensor_value", self.set_buffer)
+        self.dispatcher.map("/sensor_frame", self.set_frame)
 
     def set_addr(self, ip, port):
         self.ip = ip
@@ -133,6 +532,32 @@ class OSCServer:
         if value1 == 120:
             self.buffer.finalize()
 
+    def set_frame(self, address, *args):
+        """
+        /sensor_frame の受信
+        :param address: OSCアドレス
+        :param args: blob と，あれば整数のフレームカウンタ
+        :return: None
+        """
+        blob = None
+        counter = None
+        for arg in args:
+            if isinstance(arg, (bytes, bytearray)):
+                blob = arg
+            elif isinstance(arg, int):
+                counter = arg
+
+        if blob is None or len(blob) != self.FRAME_BYTES:
+            self.invalid_frames += 1
+            return
+
+        if counter is not None:
+            if self.frame_counter is not None and counter > self.frame_counter + 1:
+                self.lost_frames += counter - self.frame_counter - 1
+            self.frame_counter = counter
+
+        self.buffer.set_frame(np.frombuffer(blob, self.FRAME_DTYPE))
+
     def start_server(self):
         print("Starting Server")
         try:
@@ -148,47 +573,145 @@ class OSCServer:
 
     def stop(self):
         if self.running:
+            self.running = False
             self.server.shutdown()
+            self.server.server_close()
 
 
 class ObjTransmitter:
+    """
+    トラッカーのイベントをOSCで送信する
+    MODE_MESSAGE: イベント毎に個別のメッセージを送信（従来の受信側向け）
+    MODE_BUNDLE: 1フレーム分のメッセージをまとめ，end_frame() で1つのバンドルとして送信
+    """
+
+    MODE_MESSAGE = 0
+    MODE_BUNDLE = 1
 
-    def __init__(self, ip="127.0.0.1", port=9000):
+    def __init__(self, ip="127.0.0.1", port=9000, mode=MODE_MESSAGE):
         self.ip = ip
         self.port = port
         self.running = False
         self.client = udp_client.SimpleUDPClient(self.ip, self.port)
+        self.profiler = None
+        self.rate_meter = RateMeter()   # フレームの送信間隔
+
+        self.mode = mode
+        self.pending = []           # 送信待ちのメッセージ（バンドルモード）
+        self.alive_touch = set()    # 検出中のID
+        self.alive_blob = set()
 
     def set_addr(self, ip, port):
         self.ip = ip
         self.port = port
 
+    def set_mode(self, mode):
+        self.mode = mode
+        self.pending.clear()
+
+    def set_profiler(self, profiler):
+        """
+        送信時間を StageProfiler に "osc_send" として記録する
+        :param profiler: StageProfiler (Noneで記録しない)
+        """
+        self.profiler = profiler
+
+    def get_rate(self):
+        return self.rate_meter.get_rate()
+
+    def get_rate_stat(self):
+        """
+        フレームの送信間隔の統計
+        :return: RateMeter.get_stat() の辞書
+        """
+        return self.rate_meter.get_stat()
+
     def send_message(self, obj, event):
         if not self.running:
             return
+        prof = self.profiler
+        if prof is None:
+            self.__send(obj, event)
+            return
+
+        start = time.perf_counter()
+        self.__send(obj, event)
+        prof.add("osc_send", time.perf_counter() - start)
+
+    def __emit(self, address, value):
+        if self.mode == self.MODE_BUNDLE:
+            builder = osc_message_builder.OscMessageBuilder(address=address)
+            for arg in value:
+                builder.add_arg(arg)
+            self.pending.append(builder.build())
+        else:
+            self.client.send_message(address, value)
+
+    def __send(self, obj, event):
         if isinstance(obj, Touch):
             base_path = "/touch/"+str(obj.oid)
             if event is ObjTracker.EVENT_OBJ_UPDATE:
-                self.client.send_message(base_path + "/point", [int(obj.y * 0.2), int(obj.x * 0.2)])
+                self.alive_touch.add(obj.oid)
+                self.__emit(base_path + "/point", [int(obj.y * 0.2), int(obj.x * 0.2)])
             elif event is ObjTracker.EVENT_OBJ_DELETE:
-                self.client.send_message(base_path + "/delete", [-1, -1])
+                self.alive_touch.discard(obj.oid)
+                self.__emit(base_path + "/delete", [-1, -1])
 
         if isinstance(obj, Blob):
             base_path = "/blob/" + str(obj.oid)
             if event is ObjTracker.EVENT_OBJ_UPDATE:
-                self.client.send_message(base_path + "/point", obj.point)
-                self.client.send_message(base_path + "/bbox1", obj.point1)
-                self.client.send_message(base_path + "/bbox2", obj.point2)
-                self.client.send_message(base_path + "/contour", obj.shape.flatten().tolist())
+                self.alive_blob.add(obj.oid)
+                self.__emit(base_path + "/point", obj.point)
+                self.__emit(base_path + "/bbox1", obj.point1)
+                self.__emit(base_path + "/bbox2", obj.point2)
+                self.__emit(base_path + "/contour", obj.shape.flatten().tolist())
             if event is ObjTracker.EVENT_OBJ_DELETE:
-                self.client.send_message(base_path + "/delete", [-1, -1])
+                self.alive_blob.discard(obj.oid)
+                self.__emit(base_path + "/delete", [-1, -1])
+
+    def end_frame(self, seq):
+        """
+        フレームの終了（Analyzerのフレームコールバック）
+        バンドルモードでは /frame, /touch/alive, /blob/alive と送信待ちのメッセージを1つのバンドルで送信
+        :param seq: フレームのシーケンス番号
+        :return: None
+        """
+        if not self.running:
+            return
+        self.rate_meter.tick()
+        if self.mode != self.MODE_BUNDLE:
+            return
+
+        start = time.perf_counter()
+        bundle = osc_bundle_builder.OscBundleBuilder(time.time())
+        for address, value in (("/frame", [int(seq)]),
+                               ("/touch/alive", sorted(self.alive_touch)),
+                               ("/blob/alive", sorted(self.alive_blob))):
+            builder = osc_message_builder.OscMessageBuilder(address=address)
+            for arg in value:
+                builder.add_arg(int(arg))
+            bundle.add_content(builder.build())
+        for message in self.pending:
+            bundle.add_content(message)
+        self.pending.clear()
+
+        self.client.send(bundle.build())
+
+        prof = self.profiler
+        if prof is not None:
+            prof.add("osc_send", time.perf_counter() - start)
 
     def start_client(self):
         print("Starting Obj Client")
         self.client = udp_client.SimpleUDPClient(self.ip, self.port)
+        self.pending.clear()
+        self.rate_meter.reset()
         self.running = True
         print("Sending on {}".format(self.ip))
 
+    def stop(self):
+        self.running = False
+
 
 class FrameTransmitter:
 
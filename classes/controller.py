@@ -1,13 +1,13 @@
 import sys
 import tkinter as tk
-from PIL import Image, ImageTk, ImageOps
+from PIL import Image, ImageTk
 import numpy as np
 import cv2
 
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 from matplotlib.figure import Figure
 
-from classes import visualize
+from classes import visualize, filters
 
 
 class StdoutRedirector(object):
@@ -40,8 +40,8 @@ class TmView(tk.Tk):
 
         self.canvas = None
         self.canvas2 = None
-        self.photo_image = None
-        self.photo_image2 = None
+        self.canvas_image = None
+        self.canvas_image2 = None
 
         self.init_control_frame()
         self.init_setting_frame()
@@ -54,6 +54,12 @@ class TmView(tk.Tk):
 
         self.blank_image = np.zeros((160, 320, 3), dtype=np.uint8)
 
+        self.refresh_interval = 33      # 再描画の最短間隔 [ms]
+        self.drawn_seq = -1             # 描画済みの (解析結果のシーケンス番号, 表示画像の種類)
+        self.gray_buffer = np.zeros((160, 320), dtype=np.uint8)
+        self.color_buffer = np.zeros((160, 320, 3), dtype=np.uint8)
+        self.overlay_buffer = np.zeros((160, 320, 3), dtype=np.uint8)
+
         self.update()
         self.__update_image()
         self.__update_stat()
@@ -64,14 +70,41 @@ class TmView(tk.Tk):
 
         self.analyze_rate = tk.StringVar()
         self.analyze_rate.set("---fps")
-        rate_label = tk.Label(self.stat_frame, textvariable=self.analyze_rate, width=40)
+        rate_label = tk.Label(self.stat_frame, textvariable=self.analyze_rate, width=52)
         rate_label.pack()
 
         self.frame_rate = tk.StringVar()
         self.frame_rate.set("---fps")
-        frame_label = tk.Label(self.stat_frame, textvariable=self.frame_rate, width=40)
+        frame_label = tk.Label(self.stat_frame, textvariable=self.frame_rate, width=52)
         frame_label.pack()
 
+        self.send_rate = tk.StringVar()
+        self.send_rate.set("---fps")
+        send_label = tk.Label(self.stat_frame, textvariable=self.send_rate, width=52)
+        send_label.pack()
+
+        self.serial_rate = tk.StringVar()
+        serial_label = tk.Label(self.stat_frame, textvariable=self.serial_rate, width=52)
+        serial_label.pack()
+
+        self.frame_integrity = tk.StringVar()
+        integrity_label = tk.Label(self.stat_frame, textvariable=self.frame_integrity, width=40)
+        integrity_label.pack()
+
+        self.profiling = tk.BooleanVar(value=self.analyzer.profiler is not None)
+        profiling_check = tk.Checkbutton(self.stat_frame, text="Stage Timing", variable=self.profiling,
+                                         command=self._toggle_profiling)
+        profiling_check.pack()
+
+        self.stage_stat = tk.StringVar()
+        stage_label = tk.Label(self.stat_frame, textvariable=self.stage_stat, width=40, justify=tk.LEFT,
+                               font=("Courier", 9))
+        stage_label.pack()
+
+    def _toggle_profiling(self):
+        self.analyzer.set_profiling(self.profiling.get())
+        self.client.set_profiler(self.analyzer.profiler)
+
     def init_stdout_frame(self):
         stdout_frame = tk.Frame(self, pady=10, padx=10)
         stdout_frame.grid(row=3, column=0, columnspan=5, sticky=tk.W + tk.SE)
@@ -98,6 +131,15 @@ class TmView(tk.Tk):
         gsd_entry = tk.Entry(setting_frame, textvariable=grad_sd, width=10)
         gsd_entry.bind('<Return>', lambda arg: self.analyzer.set_grad(100, int(grad_sd.get())))
 
+        filter_label = tk.Label(setting_frame, text="Filter")
+        filter_type = tk.StringVar(value=self.analyzer.filter_type)
+        filter_menu = tk.OptionMenu(setting_frame, filter_type, *filters.FILTERS.keys(),
+                                    command=self.analyzer.set_filter)
+
+        touch_only = tk.BooleanVar(value=self.analyzer.mode == 1)
+        touch_only_check = tk.Checkbutton(setting_frame, text="Touch Only", variable=touch_only,
+                                          command=lambda: self.analyzer.set_mode(1 if touch_only.get() else 0))
+
         c_param = tk.StringVar(value=self.analyzer.gamma)
         param_entry = tk.Entry(setting_frame, textvariable=c_param, width=10)
         param_entry.bind('<Return>', lambda arg: self.analyzer.set_curve_param(float(c_param.get())))
@@ -110,6 +152,9 @@ class TmView(tk.Tk):
         param_entry.grid(row=3, column=1)
         grad_label.grid(row=4, column=0)
         gsd_entry.grid(row=4, column=1)
+        filter_label.grid(row=5, column=0)
+        filter_menu.grid(row=5, column=1)
+        touch_only_check.grid(row=6, column=0, columnspan=2)
 
     def init_control_frame(self):
         control_frame = tk.Frame(self, pady=10, padx=10, relief=tk.GROOVE, bd=2)
@@ -136,6 +181,12 @@ class TmView(tk.Tk):
         target_ip_entry.grid(row=2, column=1)
         client_start_button.grid(row=3, column=0, columnspan=2, pady=5)
 
+        bundle = tk.BooleanVar(value=self.client.mode == self.client.MODE_BUNDLE)
+        bundle_check = tk.Checkbutton(control_frame, text="Send as OSC Bundle", variable=bundle,
+                                      command=lambda: self.client.set_mode(
+                                          self.client.MODE_BUNDLE if bundle.get() else self.client.MODE_MESSAGE))
+        bundle_check.grid(row=4, column=0, columnspan=2)
+
     def init_view_frame(self):
         self.view_frame = tk.Frame(self, pady=10, padx=10)
         self.view_frame.grid(row=0, column=0, columnspan=5)
@@ -146,6 +197,9 @@ class TmView(tk.Tk):
         self.canvas.grid(row=0, column=0)
         self.canvas2.grid(row=0, column=1)
 
+        self.canvas_image = CanvasImage(self.canvas)
+        self.canvas_image2 = CanvasImage(self.canvas2)
+
     def init_cal_frame(self):
         cal_frame = tk.Frame(self, padx=10, pady=10, relief=tk.GROOVE, bd=2)
         cal_frame.grid(row=1, column=2, sticky=tk.N + tk.SW)
@@ -159,6 +213,9 @@ class TmView(tk.Tk):
         change_button = tk.Button(control_frame, text="Toggle Image", command=self._change_image, width=20)
 
         self.figure_frame.grid(row=0, column=0, sticky=tk.N)
+        self.sensor_figure = SensorFigure(self.figure_frame, self.calibration, self.frame)
+        self.sensor_figure.pack()
+        self.sensor_figure.update_figure()
         control_frame.grid(row=0, column=1, sticky=tk.N)
         cal_lower_button.pack()
         cal_upper_button.pack()
@@ -174,122 +231,248 @@ class TmView(tk.Tk):
         elif self.img_type == 2:
             self.img_type = 0
 
+    @staticmethod
+    def __format_rate(name, stat):
+        return "{} : {:.2f}Hz (jitter {:.1f}ms, max gap {:.0f}ms)".format(
+            name, stat["rate_hz"], stat["jitter_ms"], stat["max_gap_ms"])
+
     def __update_stat(self):
 
-        self.analyze_rate.set("Processing : " + format(self.analyzer.get_rate(), "03.2f") + "Hz")
-        self.frame_rate.set("Data Receiving : " + format(self.frame.get_rate(), "03.2f") + "Hz")
+        self.analyze_rate.set(self.__format_rate("Processing", self.analyzer.get_rate_stat()))
+        self.frame_rate.set(self.__format_rate("Data Receiving", self.frame.get_rate_stat()))
+        self.send_rate.set(self.__format_rate("Sending", self.client.get_rate_stat()))
+        serial_stat = self.server.get_stat() if hasattr(self.server, "get_stat") else None
+        if serial_stat is None:
+            self.serial_rate.set("Serial : ---")
+        else:
+            self.serial_rate.set("Serial : {:.1f} kB/s, {:.2f} frames/s".format(serial_stat[0] / 1000, serial_stat[1]))
+        integrity = self.frame.get_integrity()
+        self.frame_integrity.set("Incomplete : {} / {} frames, Input Errors : {}".format(
+            integrity["incomplete_frames"], integrity["frames"], integrity["input_errors"]))
+
+        lines = []
+        for name, stat in self.analyzer.get_stage_stat().items():
+            lines.append("{:<19}{:6.2f}/{:6.2f} ms".format(name, stat["p50_ms"], stat["p95_ms"]))
+        if lines:
+            lines.insert(0, "{:<19}{:>6}/{:>6}".format("stage", "p50", "p95"))
+        self.stage_stat.set("\n".join(lines))
 
         self.stat_frame.after(100, self.__update_stat)
 
     def __update_image(self):
+        """
+        解析結果が更新された時のみ再描画する（最大 1000 / refresh_interval Hz）
+        :return: None
+        """
         if self.analyzer.disp_img is None:
-            self.disp_image(self.blank_image)
-            self.disp2_image(self.blank_image)
+            if self.drawn_seq is not None:
+                self.disp_image(self.blank_image)
+                self.disp2_image(self.blank_image)
+                self.drawn_seq = None
             self.view_frame.after(1000, self.__update_image)
             return
 
-        self.disp_image(cv2.applyColorMap(self.analyzer.disp_img.astype(np.uint8), cv2.COLORMAP_HSV))
+        seq = (self.analyzer.output_seq, self.img_type)
+        if seq != self.drawn_seq:
+            self.drawn_seq = seq
+            self.__draw_image()
+
+        self.view_frame.after(self.refresh_interval, self.__update_image)
+
+    def __draw_image(self):
+        np.copyto(self.gray_buffer, self.analyzer.disp_img, casting='unsafe')
+        cv2.applyColorMap(self.gray_buffer, cv2.COLORMAP_HSV, dst=self.color_buffer)
+        self.disp_image(self.color_buffer)
         # self.disp_image(self.analyzer.disp_img)
         if self.img_type == 0:
-            tmp_img = self.analyzer.disp2_img.astype(np.uint8)
-            tmp_img = cv2.cvtColor(tmp_img, cv2.COLOR_GRAY2BGR)
-            visualize.visualize(tmp_img, self.analyzer.touch_tracker.get_objects())
-            visualize.visualize(tmp_img, self.analyzer.blob_tracker.get_objects())
-            self.disp2_image(tmp_img)
+            np.copyto(self.gray_buffer, self.analyzer.disp2_img, casting='unsafe')
+            cv2.cvtColor(self.gray_buffer, cv2.COLOR_GRAY2BGR, dst=self.overlay_buffer)
+            visualize.visualize(self.overlay_buffer, self.analyzer.touch_tracker.get_objects())
+            visualize.visualize(self.overlay_buffer, self.analyzer.blob_tracker.get_objects())
+            self.disp2_image(self.overlay_buffer)
         elif self.img_type == 1:
             self.disp2_image(self.analyzer.disp3_img)
         elif self.img_type == 2:
-            tmp_img = self.analyzer.disp2_img.astype(np.uint8)
-            self.disp2_image(tmp_img)
-
-        self.view_frame.after(10, self.__update_image)
+            np.copyto(self.gray_buffer, self.analyzer.disp2_img, casting='unsafe')
+            self.disp2_image(self.gray_buffer)
 
     def disp_image(self, img):
-        # NumPyのndarrayからPillowのImageへ変換
-        pil_image = Image.fromarray(img)
+        self.canvas_image.show(img)
 
-        # キャンバスのサイズを取得
-        canvas_width = self.canvas.winfo_width()
-        canvas_height = self.canvas.winfo_height()
+    def disp2_image(self, img):
+        self.canvas_image2.show(img)
 
-        # 画像のアスペクト比（縦横比）を崩さずに指定したサイズ（キャンバスのサイズ）全体に画像をリサイズする
-        pil_image = ImageOps.pad(pil_image, (canvas_width, canvas_height))
 
-        # PIL.ImageからPhotoImageへ変換する
-        self.photo_image = ImageTk.PhotoImage(image=pil_image)
+class CanvasImage:
+    """
+    キャンバス上の1つの画像アイテム
+    キャンバスサイズのバッファとPhotoImageを使い回し，画像の内容のみを書き換える
+    """
 
-        # 画像の描画
-        self.canvas.create_image(
-            canvas_width / 2,  # 画像表示位置(Canvasの中心)
-            canvas_height / 2,
-            image=self.photo_image  # 表示画像データ
-        )
+    def __init__(self, canvas):
+        self.canvas = canvas
+        self.item = None
+        self.photo_image = None
 
-    def disp2_image(self, img):
-        # NumPyのndarrayからPillowのImageへ変換
-        pil_image = Image.fromarray(img)
+        self.layout = None      # (キャンバス幅, キャンバス高さ, 画像の形状)
+        self.buffer = None      # キャンバスサイズのRGBバッファ
+        self.view = None        # バッファ中の画像領域
+        self.gray = None        # グレースケール画像の縮小用バッファ
 
+    def __update_layout(self, shape):
         # キャンバスのサイズを取得
-        canvas_width = self.canvas2.winfo_width()
-        canvas_height = self.canvas2.winfo_height()
-
-        # 画像のアスペクト比（縦横比）を崩さずに指定したサイズ（キャンバスのサイズ）全体に画像をリサイズする
-        pil_image = ImageOps.pad(pil_image, (canvas_width, canvas_height))
-
-        # PIL.ImageからPhotoImageへ変換する
-        self.photo_image2 = ImageTk.PhotoImage(image=pil_image)
-
-        # 画像の描画
-        self.canvas2.create_image(
-            canvas_width / 2,  # 画像表示位置(Canvasの中心)
-            canvas_height / 2,
-            image=self.photo_image2  # 表示画像データ
-        )
+        canvas_width = max(self.canvas.winfo_width(), 1)
+        canvas_height = max(self.canvas.winfo_height(), 1)
+        layout = (canvas_width, canvas_height, shape)
+        if layout == self.layout:
+            return
+        self.layout = layout
+
+        # 画像のアスペクト比（縦横比）を崩さずにキャンバス全体に収まる領域を計算
+        scale = min(canvas_width / shape[1], canvas_height / shape[0])
+        width = max(int(shape[1] * scale), 1)
+        height = max(int(shape[0] * scale), 1)
+        x = (canvas_width - width) // 2
+        y = (canvas_height - height) // 2
+
+        self.buffer = np.zeros((canvas_height, canvas_width, 3), np.uint8)
+        self.view = self.buffer[y:y + height, x:x + width]
+        self.gray = np.zeros((height, width), np.uint8)
+
+        self.photo_image = ImageTk.PhotoImage("RGB", (canvas_width, canvas_height))
+        if self.item is None:
+            self.item = self.canvas.create_image(canvas_width / 2, canvas_height / 2, image=self.photo_image)
+        else:
+            self.canvas.itemconfig(self.item, image=self.photo_image)
+            self.canvas.coords(self.item, canvas_width / 2, canvas_height / 2)
+
+    def show(self, img):
+        """
+        画像をキャンバスの大きさに合わせて表示
+        :param img: uint8 の画像（グレースケールまたは3ch）
+        :return: None
+        """
+        self.__update_layout(img.shape[:2])
+        size = (self.view.shape[1], self.view.shape[0])
+        if img.ndim == 2:
+            cv2.resize(img, size, dst=self.gray, interpolation=cv2.INTER_LINEAR)
+            self.view[...] = self.gray[..., None]
+        else:
+            cv2.resize(img, size, dst=self.view, interpolation=cv2.INTER_LINEAR)
+        self.photo_image.paste(Image.fromarray(self.buffer))
 
 
 class SensorFigure(tk.Frame):
+    """
+    選択したセンサの生値の推移を表示
+    リングバッファに追記し，blittingで線のみを再描画する（背景・キャリブレーション範囲は再利用）
+    """
 
-    def __init__(self, root, calibration):
+    def __init__(self, root, calibration, frame, sensors=(60,)):
         super().__init__(root, pady=10, padx=10, relief=tk.GROOVE, bd=2)
         self.figure_canvas = None
-        self.figure_length = 100
-        self.figure_data = np.zeros(self.figure_length, np.uint16)
+        self.figure_length = 300
+        self.update_interval = 33       # [ms]
         self.fig = None
         self.ax = None
         self.calibration = calibration
+        self.frame = frame
 
-        self.__init_figure()
+        self.sensors = list(sensors)
+        self.ring = np.zeros((self.figure_length, 121), np.float64)     # 全センサの履歴
+        self.ring_index = 0
+        self.frame_seq = 0
 
-    def __get_sensor_data(self, index):
-        if not self.calibration.is_calibration_available():
-            return 0
-        return self.calibration.get_sensor_data()[index]
+        self.lines = []
+        self.bands = []
+        self.cursor = None
+        self.background = None
+        self.cal_ref = None             # 表示中のキャリブレーション値
 
-    def __get_calibrate_data(self, index):
-        if not self.calibration.is_calibration_available():
-            return 0, 60000
-        cal_min = self.calibration.cal_min[index]
-        cal_max = self.calibration.cal_max[index]
+        self.__init_figure()
+        self.__init_selector()
 
+    def __get_calibrate_data(self):
+        cal_min = getattr(self.calibration, "cal_min", None)
+        cal_max = getattr(self.calibration, "cal_max", None)
+        if cal_min is None or cal_max is None:
+            return None, None
         return cal_min, cal_max
 
-    def __add_sensor_data(self, data, data_array):
-        data_array = np.roll(data_array, -1)
-        data_array[self.figure_length - 1] = data
-        return data_array
+    def set_sensors(self, sensors):
+        """
+        表示するセンサの変更
+        :param sensors: センサ番号のリスト
+        :return: None
+        """
+        sensors = [s for s in sensors if 0 <= s < 121]
+        if not sensors:
+            print('Error: Sensor index must be 0-120')
+            return
+        self.sensors = sensors
+        self.__rebuild()
+
+    def __rebuild(self):
+        """
+        線とキャリブレーション範囲を作り直して背景を再描画
+        """
+        for artist in self.lines + self.bands:
+            artist.remove()
+        self.lines = []
+        self.bands = []
+
+        cal_min, cal_max = self.__get_calibrate_data()
+        self.cal_ref = (cal_min, cal_max)
+
+        x = np.arange(self.figure_length)
+        for sensor in self.sensors:
+            line, = self.ax.plot(x, self.ring[:, sensor], animated=True, linewidth=1, label=str(sensor))
+            self.lines.append(line)
+            if cal_min is not None:
+                color = line.get_color()
+                self.bands.append(self.ax.axhline(cal_min[sensor], color=color, linestyle="--", linewidth=0.8))
+                self.bands.append(self.ax.axhline(cal_max[sensor], color=color, linestyle="--", linewidth=0.8))
+
+        if cal_min is not None:
+            low = float(np.min(cal_min[self.sensors]))
+            high = float(np.max(cal_max[self.sensors]))
+            margin = max((high - low) * 0.1, 1.0)
+            self.ax.set_ylim([low - margin, high + margin])
+        else:
+            self.ax.set_ylim([0, 65000])
 
-    def update_figure(self):
-        self.figure_data = self.__add_sensor_data(self.__get_sensor_data(60), self.figure_data)
-        fr_min, fr_max = self.__get_calibrate_data(60)
+        self.figure_canvas.draw()
 
-        self.ax.cla()
-        self.ax.grid()
-        self.ax.set_ylim([fr_min, fr_max])
-        self.ax.plot(self.figure_data)
+    def __on_draw(self, event):
+        # 背景（軸・グリッド・キャリブレーション範囲）を保存
+        self.background = self.figure_canvas.copy_from_bbox(self.ax.bbox)
+        self.__blit()
 
-        self.figure_canvas.draw()
+    def __blit(self):
+        if self.background is None:
+            return
+        self.figure_canvas.restore_region(self.background)
+        for line, sensor in zip(self.lines, self.sensors):
+            line.set_ydata(self.ring[:, sensor])
+            self.ax.draw_artist(line)
+        self.cursor.set_xdata([self.ring_index, self.ring_index])
+        self.ax.draw_artist(self.cursor)
+        self.figure_canvas.blit(self.ax.bbox)
+
+    def update_figure(self):
+        seq, data = self.frame.get_frame()
+        if data is not None and seq != self.frame_seq:
+            self.frame_seq = seq
+            self.ring[self.ring_index] = data
+            self.ring_index = (self.ring_index + 1) % self.figure_length
+
+            cal_min, cal_max = self.__get_calibrate_data()
+            if self.cal_ref[0] is not cal_min or self.cal_ref[1] is not cal_max:
+                self.__rebuild()
+            else:
+                self.__blit()
 
-        self.after(500, self.update_figure)
+        self.after(self.update_interval, self.update_figure)
 
     def __init_figure(self):
         self.fig = Figure(figsize=(3, 2))
@@ -297,7 +480,26 @@ class SensorFigure(tk.Frame):
 
         self.ax = self.fig.add_subplot(111)
         self.ax.grid()
-        self.ax.set_ylim([0, 65000])
-        self.ax.plot(self.figure_data)
+        self.ax.set_xlim([0, self.figure_length - 1])
+        self.cursor = self.ax.axvline(0, color="gray", linewidth=0.8, animated=True)
+        self.figure_canvas.mpl_connect('draw_event', self.__on_draw)
 
         self.figure_canvas.get_tk_widget().pack()
+        self.__rebuild()
+
+    def __init_selector(self):
+        selector = tk.Frame(self)
+        sensors = tk.StringVar(value=", ".join(str(s) for s in self.sensors))
+        label = tk.Label(selector, text="Sensors")
+        entry = tk.Entry(selector, textvariable=sensors, width=20)
+        entry.bind('<Return>', lambda arg: self.__select(sensors.get()))
+
+        label.pack(side=tk.LEFT)
+        entry.pack(side=tk.LEFT)
+        selector.pack()
+
+    def __select(self, text):
+        try:
+            self.set_sensors([int(s) for s in text.replace(",", " ").split()])
+        except ValueError:
+            print('Error: Sensor index must be 0-120')
@@ -0,0 +1,174 @@
+import abc
+import time
+import numpy as np
+
+
+class TemporalFilter(abc.ABC):
+    """
+    センサ値 (121,) の時間方向フィルタ
+    状態はすべて事前に確保したバッファに保持し，1フレームの更新はフレーム数に依存しない
+    apply の戻り値は出力用のバッファ（次の apply で上書きされる）
+    """
+
+    def __init__(self, size=121):
+        self.size = size
+        self.out = np.zeros(size, np.float32)
+        self.count = 0
+
+    def reset(self):
+        self.count = 0
+
+    @abc.abstractmethod
+    def apply(self, data):
+        """
+        :param data: センサ値 (121,)
+        :return: フィルタ後の値（出力用のバッファ）
+        """
+
+
+class MovingAverageFilter(TemporalFilter):
+    """
+    直近 n フレームの移動平均（合計値を差分更新）
+    """
+
+    def __init__(self, n=4, size=121):
+        super().__init__(size)
+        self.n = n
+        self.ring = np.zeros((n, size), np.float64)
+        self.sum = np.zeros(size, np.float64)
+        self.index = 0
+
+    def reset(self):
+        super().reset()
+        self.ring[:] = 0.0
+        self.sum[:] = 0.0
+        self.index = 0
+
+    def apply(self, data):
+        slot = self.ring[self.index]
+        self.sum -= slot
+        slot[:] = data
+        self.sum += slot
+        self.index = (self.index + 1) % self.n
+        self.count = min(self.count + 1, self.n)
+
+        np.divide(self.sum, self.count, out=self.out, casting="unsafe")
+        return self.out
+
+
+class EmaFilter(TemporalFilter):
+    """
+    指数移動平均
+    """
+
+    def __init__(self, alpha=0.5, size=121):
+        super().__init__(size)
+        self.alpha = alpha
+        self.value = np.zeros(size, np.float32)
+
+    def apply(self, data):
+        if self.count == 0:
+            self.value[:] = data
+        else:
+            self.value += self.alpha * (data - self.value)
+        self.count += 1
+
+        self.out[:] = self.value
+        return self.out
+
+
+class MedianFilter(TemporalFilter):
+    """
+    直近 n フレームの中央値（突発的なノイズの除去）
+    """
+
+    def __init__(self, n=3, size=121):
+        super().__init__(size)
+        self.n = n
+        self.ring = np.zeros((n, size), np.float32)
+        self.index = 0
+
+    def reset(self):
+        super().reset()
+        self.index = 0
+
+    def apply(self, data):
+        self.ring[self.index] = data
+        self.index = (self.index + 1) % self.n
+        self.count = min(self.count + 1, self.n)
+
+        np.median(self.ring[:self.count], axis=0, out=self.out)
+        return self.out
+
+
+class OneEuroFilter(TemporalFilter):
+    """
+    One Euro Filter
+    変化の速いセンサほどカットオフ周波数を上げ，静止時のジッタと動作時の遅延を両立する
+    """
+
+    def __init__(self, min_cutoff=1.0, beta=0.05, d_cutoff=1.0, size=121):
+        super().__init__(size)
+        self.min_cutoff = min_cutoff
+        self.beta = beta
+        self.d_cutoff = d_cutoff
+
+        self.value = np.zeros(size, np.float32)
+        self.deriv = np.zeros(size, np.float32)
+        self.cutoff = np.zeros(size, np.float32)
+        self.alpha = np.zeros(size, np.float32)
+        self.time_stamp = 0.0
+
+    @staticmethod
+    def smoothing(cutoff, dt):
+        tau = 1.0 / (2 * np.pi * cutoff)
+        return 1.0 / (1.0 + tau / dt)
+
+    def apply(self, data):
+        now = time.monotonic()
+        if self.count == 0:
+            self.value[:] = data
+            self.deriv[:] = 0.0
+        else:
+            dt = max(now - self.time_stamp, 1e-3)
+
+            # 変化速度の平滑化
+            a_d = self.smoothing(self.d_cutoff, dt)
+            self.deriv += a_d * ((data - self.value) / dt - self.deriv)
+
+            # 変化速度に応じたカットオフ周波数
+            np.abs(self.deriv, out=self.cutoff)
+            self.cutoff *= self.beta
+            self.cutoff += self.min_cutoff
+            np.multiply(self.cutoff, 2 * np.pi * dt, out=self.alpha)
+            np.divide(self.alpha, self.alpha + 1.0, out=self.alpha)
+
+            self.value += self.alpha * (data - self.value)
+        self.time_stamp = now
+        self.count += 1
+
+        self.out[:] = self.value
+        return self.out
+
+
+FILTERS = {
+    "none": None,
+    "average": MovingAverageFilter,
+    "ema": EmaFilter,
+    "median": MedianFilter,
+    "one_euro": OneEuroFilter,
+}
+
+
+def create_filter(name, **kwargs):
+    """
+    名前からフィルタを生成
+    :param name: FILTERS のキー
+    :return: TemporalFilter (none なら None)
+    """
+    if name not in FILTERS:
+        print('Error: Unknown filter "{}"'.format(name))
+        return None
+    if FILTERS[name] is None:
+        return None
+    return FILTERS[name](**kwargs)
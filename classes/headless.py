@@ -0,0 +1,54 @@
+import signal
+import threading
+
+from classes.pipeline import Pipeline
+
+
+def run_headless(param):
+    """
+    GUIなしで受信・解析・送信を行う（tkinter / matplotlib は読み込まない）
+    SIGTERM / SIGINT で終了する
+    :param param: 設定
+    :return: None
+    """
+    stat_interval = param.get("stat_interval", 10.0)
+
+    pipeline = Pipeline(param)
+    pipeline.calibration.load_data()
+    if not pipeline.calibration.is_calibration_available():
+        print('Error: Calibration required')
+        pipeline.stop()
+        return
+
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print("Info: Stopping ({})".format(signal.Signals(signum).name))
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    pipeline.start()
+    pipeline.server.start_server()
+    pipeline.client.start_client()
+
+    while not stop_event.wait(stat_interval):
+        seq, dropped, idle_waits = pipeline.analyzer.get_frame_stat()
+        print("Processing : {:.2f}Hz, Data Receiving : {:.2f}Hz, frame {} (dropped {})".format(
+            pipeline.analyzer.get_rate(), pipeline.frame.get_rate(), seq, dropped))
+        for name, meter in (("receive", pipeline.frame), ("analyze", pipeline.analyzer), ("send", pipeline.client)):
+            stat = meter.get_rate_stat()
+            print("  {:<8}{:7.2f}Hz, jitter {:6.2f}ms, max gap {:7.1f}ms".format(
+                name, stat["rate_hz"], stat["jitter_ms"], stat["max_gap_ms"]))
+        if hasattr(pipeline.server, "get_stat"):
+            byte_rate, frame_rate = pipeline.server.get_stat()
+            print("  serial  {:8.0f} bytes/s, {:7.2f} frames/s".format(byte_rate, frame_rate))
+        integrity = pipeline.frame.get_integrity()
+        print("  incomplete {incomplete_frames} (held {held_frames}), out of range {out_of_range}, "
+              "framing errors {framing_errors}".format(**integrity))
+        for name, stat in pipeline.analyzer.get_stage_stat().items():
+            print("  {:<19}{:6.2f}/{:6.2f} ms".format(name, stat["p50_ms"], stat["p95_ms"]))
+
+    pipeline.stop()
+    print("Info: Stopped")
@@ -0,0 +1,106 @@
+from classes import calibration, connection, analyzer, capture
+from classes.tracker import ObjTracker
+
+
+class DetectionSink:
+    """
+    トラッカーの代わりに Analyzer の1フレーム分の検出結果を保持する
+    """
+
+    def __init__(self):
+        self.objects = []
+
+    def update_frame(self, objs):
+        self.objects = objs
+
+    def get_objects(self):
+        return dict(enumerate(self.objects))
+
+
+class Pipeline:
+    """
+    settings.json に従って受信・解析・送信のインスタンスを生成し，結線する
+    GUI・ヘッドレス・解析プロセスで共通
+    detect_only なら検出のみを行い，トラッキングとOSC送信は行わない（複数パネル用）
+    """
+
+    def __init__(self, param, detect_only=False):
+        self.param = param
+        con = param["connection"]
+
+        # Sharing Data
+        self.frame = connection.TmFrame()
+        policy = param.get("frame_policy", "publish")
+        if policy in connection.TmFrame.POLICIES:
+            self.frame.set_policy(connection.TmFrame.POLICIES[policy])
+        else:
+            print('Error: Unknown frame policy "{}"'.format(policy))
+
+        # "io": "asyncio" なら受信・送信を1つのイベントループで行う
+        self.io = None
+        if param.get("io", "threads") == "asyncio":
+            from classes.aio import IoRuntime
+            self.io = IoRuntime()
+            self.io.start()
+
+        # create instance
+        self.calibration = calibration.Calibration(self.frame, False,
+                                                   param.get("calibration", "../cal_data.npz"))
+        self.server = connection.create_server(self.frame, con, self.io)
+        if detect_only:
+            self.touch_tracker = DetectionSink()
+            self.blob_tracker = DetectionSink()
+            self.client = None
+        else:
+            self.touch_tracker = ObjTracker()
+            self.blob_tracker = ObjTracker()
+            if self.io is not None:
+                from classes.aio import AsyncObjTransmitter
+                self.client = AsyncObjTransmitter(self.io, ip=con["obj_ip"])
+            else:
+                self.client = connection.ObjTransmitter(ip=con["obj_ip"])
+            if con.get("obj_bundle", False):
+                self.client.set_mode(connection.ObjTransmitter.MODE_BUNDLE)
+        self.analyzer = analyzer.Analyzer(self.calibration, self.touch_tracker, self.blob_tracker,
+                                          param.get("analysis_scale", 1.0))
+        self.analyzer.set_baseline_tracking(param.get("baseline_tracking", True))
+        self.analyzer.set_filter(param.get("filter", "none"))
+        if param.get("touch_only", False):
+            self.analyzer.set_mode(analyzer.Analyzer.MODE_TOUCH)
+
+        # record sensor frames
+        self.recorder = None
+        if "record" in con:
+            self.recorder = capture.FrameRecorder(con["record"])
+            self.frame.add_listener(self.recorder.on_frame)
+
+        # set event callback
+        if self.client is not None:
+            self.touch_tracker.set_callback(self.client.send_message)
+            self.blob_tracker.set_callback(self.client.send_message)
+            self.analyzer.set_frame_callback(self.client.end_frame)
+
+        # stage timing
+        if param.get("profiling", False):
+            self.set_profiling(True)
+
+    def set_profiling(self, enable):
+        self.analyzer.set_profiling(enable)
+        if self.client is not None:
+            self.client.set_profiler(self.analyzer.profiler)
+
+    def start(self):
+        """
+        解析スレッドのみ開始（受信・送信は start_server / start_client で開始）
+        """
+        self.analyzer.start()
+
+    def stop(self):
+        self.analyzer.stop()
+        self.server.stop()
+        if self.client is not None:
+            self.client.stop()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.io is not None:
+            self.io.stop()
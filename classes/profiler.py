@@ -0,0 +1,191 @@
+import time
+import threading
+import collections
+
+import numpy as np
+
+
+class StageProfiler:
+    """
+    処理ステージ毎の処理時間を直近 window フレーム分記録する
+    begin() → lap(name) ... → end() を1フレームとして扱う
+    """
+
+    def __init__(self, window=256):
+        self.window = window
+        self.samples = {}           # ステージ名とリングバッファ [s]
+        self.count = {}             # ステージ毎の記録数
+        self.pending = {}           # フレーム内で加算する処理時間
+        self.lock = threading.Lock()
+
+        self.last = 0.0
+
+    def begin(self):
+        self.last = time.perf_counter()
+
+    def lap(self, name):
+        """
+        前回の lap (または begin) からの経過時間を name として記録
+        """
+        now = time.perf_counter()
+        self.__record(name, now - self.last)
+        self.last = now
+
+    def add(self, name, elapsed):
+        """
+        フレーム内で複数回発生する処理の時間を加算（end() で記録）
+        加算した時間は実行中の lap から除く（ステージの時間が重複しないように）
+        """
+        self.pending[name] = self.pending.get(name, 0.0) + elapsed
+        self.last += elapsed
+
+    def end(self):
+        for name, elapsed in self.pending.items():
+            self.__record(name, elapsed)
+        self.pending.clear()
+
+    def __record(self, name, elapsed):
+        ring = self.samples.get(name)
+        if ring is None:
+            with self.lock:
+                ring = np.zeros(self.window)
+                self.samples[name] = ring
+                self.count[name] = 0
+        ring[self.count[name] % self.window] = elapsed
+        self.count[name] += 1
+
+    def reset(self):
+        with self.lock:
+            self.samples.clear()
+            self.count.clear()
+            self.pending.clear()
+
+    def get_samples(self, name):
+        """
+        :return: 記録済みの処理時間 [s]
+        """
+        with self.lock:
+            ring = self.samples.get(name)
+            if ring is None:
+                return np.zeros(0)
+            return ring[:min(self.count[name], self.window)].copy()
+
+    def get_histogram(self, name, bins=20):
+        """
+        :return: (度数, ビン境界 [ms])
+        """
+        return np.histogram(self.get_samples(name) * 1000, bins=bins)
+
+    def get_stat(self):
+        """
+        各ステージの統計
+        :return: {ステージ名: {"mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms"}}
+        """
+        with self.lock:
+            names = list(self.samples.keys())
+
+        stat = {}
+        for name in names:
+            ms = self.get_samples(name) * 1000
+            if ms.size == 0:
+                continue
+            p50, p95, p99 = np.percentile(ms, [50, 95, 99])
+            stat[name] = {
+                "mean_ms": float(ms.mean()),
+                "p50_ms": float(p50),
+                "p95_ms": float(p95),
+                "p99_ms": float(p99),
+                "max_ms": float(ms.max()),
+            }
+        return stat
+
+
+class RateMeter:
+    """
+    イベントの到着間隔から直近 window 秒のレート・ジッタ・最大間隔を求める
+    間隔の合計・二乗和を差分更新し，最大値は単調減少の deque で保持するため1回の記録は O(1)（償却）
+    tick() は1スレッドから，get_stat() / get_rate() は任意のスレッドから呼べる
+    """
+
+    def __init__(self, window=2.0):
+        self.window = window
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.samples = collections.deque()     # (到着時刻, 直前からの間隔)
+            self.maxima = collections.deque()      # 間隔の最大値候補（間隔の降順）
+            self.sum = 0.0
+            self.sum_sq = 0.0
+            self.last = None
+            self.count = 0                         # 記録したイベントの総数
+
+    def tick(self, now=None):
+        """
+        イベントの到着を記録
+        :param now: time.monotonic() の時刻（省略時は現在時刻）
+        :return: None
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            self.count += 1
+            last = self.last
+            self.last = now
+            if last is not None:
+                interval = now - last
+                self.samples.append((now, interval))
+                self.sum += interval
+                self.sum_sq += interval * interval
+                while self.maxima and self.maxima[-1][1] <= interval:
+                    self.maxima.pop()
+                self.maxima.append((now, interval))
+            self.__expire(now)
+
+    def __expire(self, now):
+        limit = now - self.window
+        samples = self.samples
+        while samples and samples[0][0] < limit:
+            t, interval = samples.popleft()
+            self.sum -= interval
+            self.sum_sq -= interval * interval
+            if self.maxima[0][0] == t:
+                self.maxima.popleft()
+        if not samples:
+            # 差分更新の誤差をリセット
+            self.sum = 0.0
+            self.sum_sq = 0.0
+
+    def get_stat(self):
+        """
+        直近 window 秒の統計
+        途絶えている間は現在までの経過時間を最大間隔とし，window 秒を超えるとレートは0になる
+        :return: {"rate_hz", "jitter_ms", "max_gap_ms", "count"}
+        """
+        now = time.monotonic()
+        with self.lock:
+            self.__expire(now)
+            n = len(self.samples)
+            rate = n / self.sum if n > 0 and self.sum > 0.0 else 0.0
+            jitter = 0.0
+            if n > 1:
+                mean = self.sum / n
+                jitter = max(self.sum_sq / n - mean * mean, 0.0) ** 0.5
+            max_gap = self.maxima[0][1] if self.maxima else 0.0
+            if self.last is not None:
+                max_gap = max(max_gap, now - self.last)
+            count = self.count
+
+        return {
+            "rate_hz": rate,
+            "jitter_ms": jitter * 1000,
+            "max_gap_ms": max_gap * 1000,
+            "count": count,
+        }
+
+    def get_rate(self):
+        """
+        :return: 直近 window 秒の平均レート [Hz]
+        """
+        return self.get_stat()["rate_hz"]
@@ -0,0 +1,369 @@
+import sys
+import time
+import signal
+import threading
+import multiprocessing
+
+import numpy as np
+
+from classes import connection
+from classes.analyzer import REFERENCE_SIZE
+from classes.tracker import ObjTracker, Touch, Blob
+from classes.worker import SharedRing, AnalysisProcess, LogWriter, write_objects, read_objects, next_command, \
+    MAX_OBJECTS, OBJ_FIELDS, BLOB_SHAPE, STAT_SIZE, STAT_FRAME_SEQ, STAT_DROPPED, \
+    STAT_CALIBRATED, STAT_INCOMPLETE, STAT_INPUT_ERRORS, STAT_ANALYZE_RATE, RATE_ANALYZE, RATE_FRAME
+
+
+def panel_param(param, panel):
+    """
+    パネル毎の設定を作成
+    :param param: 全体の設定
+    :param panel: settings.json の "panels" の要素
+    :return: Pipeline 用の設定
+    """
+    sub = {key: value for key, value in param.items() if key != "panels"}
+    con = dict(param.get("connection", {}))
+    for key in ("sensor_addr", "replay", "record"):
+        con.pop(key, None)
+        if key in panel:
+            con[key] = panel[key]
+    sub["connection"] = con
+    if "calibration" in panel:
+        sub["calibration"] = panel["calibration"]
+    return sub
+
+
+class Placement:
+    """
+    パネル座標系 (REFERENCE_SIZE) から全体座標系への変換
+    パネル左上を原点に rotation 度（90度単位，時計回り）回転した後 offset だけ平行移動する
+    """
+
+    def __init__(self, offset=(0, 0), rotation=0):
+        if rotation % 90 != 0:
+            print('Error: Panel rotation must be a multiple of 90 ({})'.format(rotation))
+            rotation = 0
+        self.offset = (float(offset[0]), float(offset[1]))
+        self.rotation = rotation % 360
+
+    def apply(self, x, y):
+        h, w = REFERENCE_SIZE
+        if self.rotation == 90:
+            x, y = h - y, x
+        elif self.rotation == 180:
+            x, y = w - x, h - y
+        elif self.rotation == 270:
+            x, y = y, w - x
+        return x + self.offset[0], y + self.offset[1]
+
+    def touch(self, touch):
+        return Touch(self.apply(*touch.point))
+
+    def blob(self, blob):
+        x1, y1 = self.apply(*blob.point1)
+        x2, y2 = self.apply(*blob.point2)
+        shape = np.ascontiguousarray(np.rot90(blob.shape, -(self.rotation // 90)))     # 時計回りに回転
+        return Blob(self.apply(*blob.point), (min(x1, x2), min(y1, y2)), (max(x1, x2), max(y1, y2)), shape)
+
+
+def merge_touches(touches, distance):
+    """
+    パネルの境界で重複したタッチを統合
+    異なるパネルの distance 以内のタッチは1つにまとめる（座標は平均）
+    :param touches: (パネル番号, Touch) のリスト
+    :param distance: 同一とみなす距離 [px]
+    :return: Touchのリスト
+    """
+    merged = []
+    used = [False] * len(touches)
+    for i, (panel_i, touch_i) in enumerate(touches):
+        if used[i]:
+            continue
+        points = [touch_i.point]
+        panels = {panel_i}
+        for j in range(i + 1, len(touches)):
+            panel_j, touch_j = touches[j]
+            if used[j] or panel_j in panels:
+                continue
+            if np.hypot(touch_j.point[0] - touch_i.point[0], touch_j.point[1] - touch_i.point[1]) < distance:
+                points.append(touch_j.point)
+                panels.add(panel_j)
+                used[j] = True
+        merged.append(Touch(np.mean(points, axis=0)))
+    return merged
+
+
+def merge_blobs(blobs, distance):
+    """
+    パネルの境界で分割されたブロブを統合
+    異なるパネルのブロブで，外接矩形が distance 以内まで近いものは外接矩形を合わせる
+    :param blobs: (パネル番号, Blob) のリスト
+    :param distance: 統合する距離 [px]
+    :return: Blobのリスト
+    """
+    groups = [({panel}, [blob]) for panel, blob in blobs]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(groups)):
+            for j in range(i + 1, len(groups)):
+                if groups[i][0] & groups[j][0]:
+                    continue
+                if any(blob_gap(a, b) <= distance for a in groups[i][1] for b in groups[j][1]):
+                    groups[i] = (groups[i][0] | groups[j][0], groups[i][1] + groups[j][1])
+                    del groups[j]
+                    merged = True
+                    break
+            if merged:
+                break
+
+    results = []
+    for panels, members in groups:
+        if len(members) == 1:
+            results.append(members[0])
+            continue
+        point1 = (min(b.point1[0] for b in members), min(b.point1[1] for b in members))
+        point2 = (max(b.point2[0] for b in members), max(b.point2[1] for b in members))
+        point = np.mean([b.point for b in members], axis=0)
+        results.append(Blob(point, point1, point2, members[0].shape))
+    return results
+
+
+def blob_gap(a, b):
+    """
+    2つのブロブの外接矩形の間隔（重なっていれば0）
+    """
+    dx = max(a.point1[0] - b.point2[0], b.point1[0] - a.point2[0], 0)
+    dy = max(a.point1[1] - b.point2[1], b.point1[1] - a.point2[1], 0)
+    return max(dx, dy)
+
+
+def run_panel(param, specs, commands, events, updated):
+    """
+    パネル毎の解析プロセスの本体
+    センサの受信と検出のみを行い，検出結果（パネル座標系）を共有メモリに書き込む
+    :param updated: 検出結果を書き込む度にセットする multiprocessing.Event（全パネルで共有）
+    """
+    from classes.pipeline import Pipeline
+
+    sys.stdout = LogWriter(events)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)    # 終了は親プロセスからのコマンドで行う
+    rings = {key: SharedRing.attach(spec) for key, spec in specs.items()}
+
+    pipeline = Pipeline(param, detect_only=True)
+    t_analyzer = pipeline.analyzer
+    pipeline.calibration.load_data()
+
+    targets = {
+        "analyzer": t_analyzer,
+        "server": pipeline.server,
+        "calibration": pipeline.calibration,
+    }
+
+    objects = np.zeros(rings["objects"].shape, np.float64)
+    shapes = np.zeros(rings["shapes"].shape, np.uint8)
+    stat = np.zeros(STAT_SIZE, np.float64)
+
+    def publish(seq):
+        write_objects(objects[0], pipeline.touch_tracker.get_objects())
+        write_objects(objects[1], pipeline.blob_tracker.get_objects(), shapes)
+        rings["shapes"].write(shapes)       # objects と同じシーケンス番号になる
+        rings["objects"].write(objects)
+        updated.set()
+
+    t_analyzer.set_frame_callback(publish)
+    pipeline.start()
+    pipeline.server.start_server()
+
+    while True:
+        command = next_command(commands, stat, pipeline, rings["stat"])
+        if command is None:
+            break
+        target, method, args = command
+        try:
+            getattr(targets[target], method)(*args)
+        except Exception as e:
+            print("Error: {}.{} failed ({})".format(target, method, e))
+
+    pipeline.stop()
+    for ring in rings.values():
+        ring.close()
+
+
+class Panel:
+    """
+    1枚のパネルの解析プロセスと配置
+    """
+
+    def __init__(self, index, param, panel, updated):
+        self.index = index
+        self.name = panel.get("name", "panel{}".format(index))
+        self.placement = Placement(panel.get("offset", (0, 0)), panel.get("rotation", 0))
+        self.process = AnalysisProcess(panel_param(param, panel), run_panel, {
+            "objects": SharedRing((2, MAX_OBJECTS, OBJ_FIELDS), np.float64),
+            "shapes": SharedRing((MAX_OBJECTS,) + BLOB_SHAPE, np.uint8),
+            "stat": SharedRing((STAT_SIZE,), np.float64),
+        }, (updated,))
+
+        self.seq = 0                # 最新の検出結果のシーケンス番号
+        self.fresh = False          # 前回の統合以降に検出結果が更新されたか
+        self.time_stamp = 0.0       # 最後に検出結果が更新された時刻 (time.monotonic)
+
+    def read(self):
+        """
+        最新の検出結果を全体座標系で取得
+        :return: (touches, blobs)
+        """
+        seq, objects = self.process.rings["objects"].latest()
+        if objects is None:
+            return [], []
+        shapes = self.process.rings["shapes"].get(seq)
+        touches = [self.placement.touch(obj) for obj in read_objects(objects[0], False).values()]
+        blobs = [self.placement.blob(obj) for obj in read_objects(objects[1], True, shapes).values()]
+        return touches, blobs
+
+
+class TiledPipeline:
+    """
+    複数パネルをパネル毎のプロセスで解析し，1つの座標系で追跡・送信する
+    """
+
+    def __init__(self, param):
+        self.param = param
+        con = param["connection"]
+
+        self.updated = multiprocessing.Event()     # いずれかのパネルが検出結果を書き込んだ
+        self.panels = [Panel(i, param, panel, self.updated) for i, panel in enumerate(param["panels"])]
+        self.seam_distance = param.get("seam_distance", 20)
+        self.stale_time = param.get("panel_timeout", 0.2)      # これより更新のないパネルの結果は使わない
+        self.merge_window = param.get("merge_window")          # 全パネルの更新を待つ最大時間 [s]（None なら自動）
+
+        self.touch_tracker = ObjTracker()
+        self.blob_tracker = ObjTracker()
+        for tracker in (self.touch_tracker, self.blob_tracker):
+            # 1パネル分の上限をパネル数倍する
+            tracker.config(ObjTracker.CONFIG_DETECTION_MAX, tracker.max_detection * len(self.panels))
+        self.client = connection.ObjTransmitter(ip=con["obj_ip"])
+        if con.get("obj_bundle", False):
+            self.client.set_mode(connection.ObjTransmitter.MODE_BUNDLE)
+        self.touch_tracker.set_callback(self.client.send_message)
+        self.blob_tracker.set_callback(self.client.send_message)
+
+        self.frame_seq = 0
+        self.running = False
+        self.thread = None
+
+    def start(self):
+        for panel in self.panels:
+            panel.process.start()
+        self.client.start_client()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.__merge, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        for panel in self.panels:
+            panel.process.stop()
+
+    def __get_merge_window(self):
+        """
+        全パネルの更新を待つ最大時間
+        自動の場合は最も速いパネルの1フレーム分（遅いパネルの結果はそのまま使う）
+        """
+        if self.merge_window is not None:
+            return self.merge_window
+        rate = max(panel.process.get_stat(STAT_ANALYZE_RATE) for panel in self.panels)
+        if rate <= 0.0:
+            return self.stale_time
+        return min(1.0 / rate, self.stale_time)
+
+    def __merge(self):
+        """
+        パネルの検出結果をフレーム単位で統合して追跡する
+        有効な全パネルの結果が更新されるか，最初の更新から merge_window 経過したら1回統合する
+        これにより各パネルの結果は1回ずつトラッカーに渡り，送信レートはパネルのフレームレートと同じになる
+        """
+        first_update = None
+        timeout = 0.1
+        while self.running:
+            self.updated.wait(timeout)
+            self.updated.clear()
+
+            now = time.monotonic()
+            for panel in self.panels:
+                seq = panel.process.rings["objects"].latest()[0]
+                if seq != panel.seq:
+                    panel.seq = seq
+                    panel.fresh = True
+                    panel.time_stamp = now
+
+            live = [panel for panel in self.panels if now - panel.time_stamp <= self.stale_time]
+            if not any(panel.fresh for panel in live):
+                timeout = 0.1
+                continue
+            if first_update is None:
+                first_update = now
+            deadline = first_update + self.__get_merge_window()
+            if not all(panel.fresh for panel in live) and now < deadline:
+                timeout = deadline - now
+                continue
+
+            touches = []
+            blobs = []
+            for panel in live:
+                panel.fresh = False
+                panel_touches, panel_blobs = panel.read()
+                touches.extend((panel.index, touch) for touch in panel_touches)
+                blobs.extend((panel.index, blob) for blob in panel_blobs)
+            first_update = None
+            timeout = 0.1
+
+            self.frame_seq += 1
+            self.touch_tracker.update_frame(merge_touches(touches, self.seam_distance))
+            self.blob_tracker.update_frame(merge_blobs(blobs, self.seam_distance))
+            self.client.end_frame(self.frame_seq)
+
+
+def run_tiled(param):
+    """
+    複数パネルの構成をGUIなしで実行する
+    SIGTERM / SIGINT で終了する
+    :param param: 設定（"panels" を含む）
+    :return: None
+    """
+    stat_interval = param.get("stat_interval", 10.0)
+
+    pipeline = TiledPipeline(param)
+    pipeline.start()
+
+    stop_event = threading.Event()
+
+    def request_stop(signum, frame):
+        print("Info: Stopping ({})".format(signal.Signals(signum).name))
+        stop_event.set()
+
+    signal.signal(signal.SIGTERM, request_stop)
+    signal.signal(signal.SIGINT, request_stop)
+
+    while not stop_event.wait(stat_interval):
+        send = pipeline.client.get_rate_stat()
+        print("Merged frame {}, touches {}, blobs {}, Sending : {:.2f}Hz (jitter {:.1f}ms, max gap {:.1f}ms)".format(
+            pipeline.frame_seq, len(pipeline.touch_tracker.get_objects()), len(pipeline.blob_tracker.get_objects()),
+            send["rate_hz"], send["jitter_ms"], send["max_gap_ms"]))
+        for panel in pipeline.panels:
+            worker = panel.process
+            analyze = worker.get_rate_stat(RATE_ANALYZE)
+            receive = worker.get_rate_stat(RATE_FRAME)
+            print("  {:<10} Processing : {:.2f}Hz, Data Receiving : {:.2f}Hz (jitter {:.1f}ms, max gap {:.1f}ms), "
+                  "frame {} (dropped {}), incomplete {}, input errors {}{}".format(
+                      panel.name, analyze["rate_hz"], receive["rate_hz"], receive["jitter_ms"], receive["max_gap_ms"],
+                      int(worker.get_stat(STAT_FRAME_SEQ)), int(worker.get_stat(STAT_DROPPED)),
+                      int(worker.get_stat(STAT_INCOMPLETE)), int(worker.get_stat(STAT_INPUT_ERRORS)),
+                      "" if worker.get_stat(STAT_CALIBRATED) > 0 else ", not calibrated"))
+
+    pipeline.stop()
+    print("Info: Stopped")
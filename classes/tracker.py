@@ -3,6 +3,7 @@ import time
 
 import numpy as np
 import cv2
+from scipy.optimize import linear_sum_assignment
 
 
 class Object:
@@ -117,7 +118,8 @@ class ObjTracker:
         フレーム終了の時間を記録
         :return: None
         """
-        self.__cleanup(self.candidate)
+        for obj in self.__cleanup(self.candidate):
+            self.updated_id.pop(obj.oid, None)
         cleaned = self.__cleanup(self.touch_dict, self.lifetime_raising)
         for obj in cleaned:
             self.__call_event(obj, self.EVENT_OBJ_DELETE)
@@ -189,9 +191,74 @@ class ObjTracker:
                 self.__add_object(obj, self.touch_dict)
             # 候補をアップデート
             else:
-                self.candidate[candidate_id] = obj
-                self.updated_id[candidate_id] += 1
+                self.__update_candidate(obj, candidate_id)
 
         # 検出中
         elif candidate_id == -1 and detected_id != -1:
             self.__update_point(obj, detected_id)
+
+    def __update_candidate(self, obj, num):
+        obj.set_id(num)
+        obj.timestamp = self.fixed_timestamp
+        self.candidate[num] = obj
+        self.updated_id[num] += 1
+
+    def __assign(self, points, dic):
+        """
+        検出座標と辞書内のオブジェクトを距離の総和が最小になるよう対応付ける
+        :param points: 検出座標 (N, 2)
+        :param dic: 辞書
+        :return: (対応付いた [(検出番号, ID)], 対応の無い検出番号)
+        """
+        detections = np.arange(points.shape[0])
+        if len(dic) == 0 or points.shape[0] == 0:
+            return [], detections
+
+        ids = list(dic.keys())
+        tracked = np.array([[p.x, p.y] for p in dic.values()], dtype=np.float64)
+        distance = np.hypot(points[:, None, 0] - tracked[None, :, 0], points[:, None, 1] - tracked[None, :, 1])
+
+        # 閾値以上の組み合わせは採用しない
+        gated = distance < self.threshold
+        cost = np.where(gated, distance, self.threshold * (points.shape[0] + len(ids) + 1))
+        rows, cols = linear_sum_assignment(cost)
+        valid = gated[rows, cols]
+
+        matched = [(row, ids[col]) for row, col in zip(rows[valid].tolist(), cols[valid].tolist())]
+        unmatched = np.setdiff1d(detections, rows[valid])
+        return matched, unmatched
+
+    def update_frame(self, objs):
+        """
+        1フレーム分の検出オブジェクトをまとめて対応付け，フレームを終了する
+        検出中 → 候補 → 新規 の順に最適割り当てを行う
+        :param objs: 検出オブジェクトのリスト
+        :return: 前フレームの終了時刻
+        """
+        points = np.array([[obj.x, obj.y] for obj in objs], dtype=np.float64).reshape(-1, 2)
+
+        # 検出中
+        matched, remaining = self.__assign(points, self.touch_dict)
+        for det, num in matched:
+            self.__update_point(objs[det], num)
+
+        # 候補
+        matched, remaining_idx = self.__assign(points[remaining], self.candidate)
+        for det, num in matched:
+            obj = objs[remaining[det]]
+            if self.updated_id[num] > self.lifetime_raising and len(self.touch_dict) < self.max_detection:
+                # 採用
+                self.candidate.pop(num)
+                self.updated_id.pop(num)
+                self.__add_object(obj, self.touch_dict)
+            else:
+                self.__update_candidate(obj, num)
+
+        # 候補でも，検出中でもない
+        for det in remaining[remaining_idx]:
+            if len(self.candidate) >= self.max_detection:
+                break
+            index = self.__add_object(objs[det], self.candidate)
+            self.updated_id[index] = 1
+
+        return self.end_frame()
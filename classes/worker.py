@@ -0,0 +1,623 @@
+import sys
+import time
+import queue
+import threading
+import multiprocessing
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from classes.tracker import Touch, Blob
+
+
+class SharedRing:
+    """
+    multiprocessing.shared_memory 上の固定長スロットのリングバッファ
+    書き込みは1プロセス・1スレッドのみ．読み出し側はスロットをコピーせずに参照する
+    参照したスロットは slots - 1 回分の書き込みまで有効
+    """
+
+    def __init__(self, shape, dtype, slots=4, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self.slots = slots
+
+        header_size = 8 * (slots + 1)
+        slot_size = int(np.prod(self.shape)) * self.dtype.itemsize
+        create = name is None
+        self.shm = shared_memory.SharedMemory(name=name, create=create, size=header_size + slot_size * slots)
+
+        # header[0]: 最新のシーケンス番号, header[1:]: 各スロットのシーケンス番号（-1は書き込み中）
+        self.header = np.ndarray((slots + 1,), np.int64, self.shm.buf)
+        self.data = np.ndarray((slots,) + self.shape, self.dtype, self.shm.buf, offset=header_size)
+        if create:
+            self.header[:] = 0
+
+    def spec(self):
+        """
+        子プロセスで同じリングを開くためのパラメータ
+        """
+        return self.shape, self.dtype.str, self.slots, self.shm.name
+
+    @classmethod
+    def attach(cls, spec):
+        shape, dtype, slots, name = spec
+        return cls(shape, dtype, slots, name)
+
+    def write(self, array):
+        """
+        次のスロットに書き込んで公開する
+        :param array: 書き込むデータ
+        :return: シーケンス番号
+        """
+        seq = int(self.header[0]) + 1
+        slot = seq % self.slots
+        self.header[slot + 1] = -1
+        self.data[slot] = array
+        self.header[slot + 1] = seq
+        self.header[0] = seq
+        return seq
+
+    def latest(self):
+        """
+        最新のスロットを参照
+        :return: (シーケンス番号, スロットのビュー)．未書き込みなら (0, None)
+        """
+        while True:
+            seq = int(self.header[0])
+            if seq == 0:
+                return 0, None
+            slot = seq % self.slots
+            if self.header[slot + 1] == seq:
+                return seq, self.data[slot]
+
+    def get(self, seq):
+        """
+        シーケンス番号を指定してスロットを参照
+        :return: スロットのビュー．上書き済み・未書き込みなら None
+        """
+        slot = seq % self.slots
+        if seq <= 0 or self.header[slot + 1] != seq:
+            return None
+        return self.data[slot]
+
+    def close(self):
+        self.header = None
+        self.data = None
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+# 解析プロセスから公開するデータ
+STAT_ANALYZE_RATE = 0
+STAT_FRAME_RATE = 1
+STAT_FRAME_SEQ = 2
+STAT_DROPPED = 3
+STAT_IDLE_WAITS = 4
+STAT_CALIBRATED = 5
+STAT_INCOMPLETE = 6         # 欠けのあったフレーム数
+STAT_INPUT_ERRORS = 7       # 範囲外のピクセル番号とSLIPの不正なパケットの数
+STAT_ANALYZE_JITTER = 8     # [ms]
+STAT_ANALYZE_GAP = 9        # [ms]
+STAT_FRAME_JITTER = 10
+STAT_FRAME_GAP = 11
+STAT_SEND_RATE = 12
+STAT_SEND_JITTER = 13
+STAT_SEND_GAP = 14
+STAT_RECEIVED = 15          # 受信して確定したフレーム数
+STAT_SERIAL_BYTES = 16      # シリアルの受信レート [bytes/s]（シリアル以外の入力では -1）
+STAT_SERIAL_FRAMES = 17     # シリアルの受信レート [frames/s]
+STAT_SIZE = 18
+STAT_INTERVAL = 0.1         # 統計を書き込む間隔 [s]（解析の有無に関わらず更新する）
+
+# RateMeter.get_stat() の各値の格納位置 (rate_hz, jitter_ms, max_gap_ms)
+RATE_ANALYZE = (STAT_ANALYZE_RATE, STAT_ANALYZE_JITTER, STAT_ANALYZE_GAP)
+RATE_FRAME = (STAT_FRAME_RATE, STAT_FRAME_JITTER, STAT_FRAME_GAP)
+RATE_SEND = (STAT_SEND_RATE, STAT_SEND_JITTER, STAT_SEND_GAP)
+RATE_KEYS = ("rate_hz", "jitter_ms", "max_gap_ms")
+
+MAX_OBJECTS = 16
+OBJ_FIELDS = 7      # oid, x, y, x1, y1, x2, y2
+BLOB_SHAPE = (16, 16)   # Blob.shape
+
+
+def write_objects(dst, objects, shapes=None):
+    """
+    トラッカーのオブジェクトを固定長の配列に格納
+    :param shapes: Blob.shape の格納先 (MAX_OBJECTS,) + BLOB_SHAPE（None なら格納しない）
+    """
+    dst[:, 0] = -1
+    for row, (oid, obj) in enumerate(list(objects.items())[:MAX_OBJECTS]):
+        dst[row, 0] = oid
+        dst[row, 1:3] = obj.point
+        if isinstance(obj, Blob):
+            dst[row, 3:5] = obj.point1
+            dst[row, 5:7] = obj.point2
+            if shapes is not None:
+                shapes[row] = obj.shape
+
+
+def write_rate_stat(stat, indices, rate_stat):
+    """
+    RateMeter.get_stat() の値を統計の配列に格納
+    :param stat: 統計の配列
+    :param indices: RATE_ANALYZE / RATE_FRAME / RATE_SEND
+    :param rate_stat: RateMeter.get_stat() の辞書
+    """
+    for index, key in zip(indices, RATE_KEYS):
+        stat[index] = rate_stat[key]
+
+
+def write_stat(stat, pipeline):
+    """
+    Pipeline の受信・解析・送信の統計を配列に格納
+    :param stat: STAT_SIZE の配列
+    :param pipeline: Pipeline（client が None なら送信の統計は0）
+    """
+    frame = pipeline.frame
+    write_rate_stat(stat, RATE_ANALYZE, pipeline.analyzer.get_rate_stat())
+    write_rate_stat(stat, RATE_FRAME, frame.get_rate_stat())
+    if pipeline.client is not None:
+        write_rate_stat(stat, RATE_SEND, pipeline.client.get_rate_stat())
+    stat[STAT_FRAME_SEQ:STAT_IDLE_WAITS + 1] = pipeline.analyzer.get_frame_stat()
+    stat[STAT_CALIBRATED] = pipeline.calibration.is_calibration_available()
+    stat[STAT_RECEIVED] = frame.seq
+    stat[STAT_INCOMPLETE] = frame.incomplete_frames
+    stat[STAT_INPUT_ERRORS] = frame.out_of_range + frame.framing_errors
+    get_serial_stat = getattr(pipeline.server, "get_stat", None)
+    if get_serial_stat is None:
+        stat[STAT_SERIAL_BYTES:STAT_SERIAL_FRAMES + 1] = (-1.0, 0.0)
+    else:
+        stat[STAT_SERIAL_BYTES:STAT_SERIAL_FRAMES + 1] = get_serial_stat()
+
+
+def next_command(commands, stat, pipeline, ring, on_interval=None):
+    """
+    コマンドを待つ間，STAT_INTERVAL 毎に統計を書き込む
+    統計は解析プロセスのメインスレッドのみが書き込む（SharedRing の書き込みは1スレッド）
+    :param on_interval: 統計と同じ間隔で呼ぶ関数（None なら呼ばない）
+    :return: コマンド（終了なら None）
+    """
+    while True:
+        write_stat(stat, pipeline)
+        ring.write(stat)
+        if on_interval is not None:
+            on_interval()
+        try:
+            return commands.get(timeout=STAT_INTERVAL)
+        except queue.Empty:
+            continue
+
+
+def write_calibration(ring, calibration, published):
+    """
+    キャリブレーション値が変わっていれば (cal_min, cal_max) をリングバッファに書き込む
+    Calibration は値を更新する度に新しい配列を代入するため，配列の同一性で変化を判定する
+    :param ring: (2, 121) float64 のリングバッファ（未設定の値は NaN）
+    :param calibration: Calibration
+    :param published: 前回書き込んだ (cal_min, cal_max)．書き込んだら更新する
+    :return: None
+    """
+    limits = (calibration.cal_min, calibration.cal_max)
+    if limits[0] is published[0] and limits[1] is published[1]:
+        return
+    data = np.full(ring.shape, np.nan)
+    for row, values in zip(data, limits):
+        if values is not None:
+            row[:] = values
+    ring.write(data)
+    published[:] = limits
+
+
+def read_objects(src, blob, shapes=None):
+    """
+    固定長の配列からオブジェクトの辞書を復元
+    :param shapes: write_objects で格納した Blob.shape（None なら形状は空）
+    """
+    objects = {}
+    for row in np.flatnonzero(src[:, 0] >= 0):
+        oid = int(src[row, 0])
+        if blob:
+            shape = shapes[row] if shapes is not None else np.zeros((1, 1), np.uint8)
+            obj = Blob(src[row, 1:3], src[row, 3:5], src[row, 5:7], shape, oid)
+        else:
+            obj = Touch(src[row, 1:3], oid)
+        objects[oid] = obj
+    return objects
+
+
+class LogWriter:
+    """
+    子プロセスの標準出力を親プロセスへ転送
+    """
+
+    def __init__(self, events):
+        self.events = events
+
+    def write(self, string):
+        self.events.put(("log", string))
+
+    def flush(self, *args):
+        pass
+
+
+def run_worker(param, specs, commands, events):
+    """
+    解析プロセスの本体
+    センサの受信・解析・OSC送信を行い，結果を共有メモリに書き込む
+    """
+    from classes.pipeline import Pipeline
+
+    sys.stdout = LogWriter(events)
+    rings = {key: SharedRing.attach(spec) for key, spec in specs.items()}
+
+    pipeline = Pipeline(param)
+    t_frame = pipeline.frame
+    t_calibration = pipeline.calibration
+    t_touch_track = pipeline.touch_tracker
+    t_blob_track = pipeline.blob_tracker
+    t_obj_client = pipeline.client
+    t_analyzer = pipeline.analyzer
+
+    targets = {
+        "analyzer": t_analyzer,
+        "server": pipeline.server,
+        "client": t_obj_client,
+        "calibration": t_calibration,
+    }
+
+    t_frame.add_listener(lambda seq, frame, time_stamp: rings["frame"].write(frame))
+
+    display = np.zeros(rings["display"].shape, np.uint8)
+    objects = np.zeros(rings["objects"].shape, np.float64)
+    stat = np.zeros(STAT_SIZE, np.float64)
+    stage_time = [0.0]
+
+    def publish(seq):
+        t_obj_client.end_frame(seq)
+
+        display[0] = t_analyzer.disp_img
+        display[1] = t_analyzer.disp3_img
+        rings["display"].write(display)
+
+        write_objects(objects[0], t_touch_track.get_objects())
+        write_objects(objects[1], t_blob_track.get_objects())
+        rings["objects"].write(objects)
+
+        now = time.time()
+        if t_analyzer.profiler is not None and now - stage_time[0] > 0.5:
+            events.put(("stage", t_analyzer.get_stage_stat()))
+            stage_time[0] = now
+
+    t_analyzer.set_frame_callback(publish)
+    pipeline.start()
+
+    published = [None, None]
+
+    def publish_calibration():
+        write_calibration(rings["calibration"], t_calibration, published)
+
+    while True:
+        command = next_command(commands, stat, pipeline, rings["stat"], publish_calibration)
+        if command is None:
+            break
+        target, method, args = command
+        try:
+            getattr(targets[target], method)(*args)
+        except Exception as e:
+            print("Error: {}.{} failed ({})".format(target, method, e))
+        if method == "set_profiling":
+            t_obj_client.set_profiler(t_analyzer.profiler)
+
+    pipeline.stop()
+    for ring in rings.values():
+        ring.close()
+
+
+class AnalysisProcess:
+    """
+    受信と解析を別プロセスで実行する
+    GUIは共有メモリのリングバッファを読むだけなので，描画が解析を妨げない
+    """
+
+    def __init__(self, param, target=run_worker, rings=None, args=()):
+        """
+        :param param: 設定
+        :param target: 子プロセスで実行する関数 target(param, specs, commands, events, *args)
+        :param rings: 共有するリングバッファの辞書（None なら GUI 用の構成）
+        :param args: target に追加で渡す引数
+        """
+        self.param = param
+
+        if rings is None:
+            rings = {
+                "frame": SharedRing((121,), np.uint16),
+                "display": SharedRing((2, 160, 320), np.uint8),
+                "objects": SharedRing((2, MAX_OBJECTS, OBJ_FIELDS), np.float64),
+                "stat": SharedRing((STAT_SIZE,), np.float64),
+                "calibration": SharedRing((2, 121), np.float64),
+            }
+        self.rings = rings
+        self.commands = multiprocessing.Queue()
+        self.events = multiprocessing.Queue()
+        self.stage_stat = {}
+
+        specs = {key: ring.spec() for key, ring in self.rings.items()}
+        self.process = multiprocessing.Process(target=target,
+                                               args=(param, specs, self.commands, self.events) + tuple(args),
+                                               daemon=True)
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.process.start()
+        self.thread = threading.Thread(target=self.__forward, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if not self.running:
+            return
+        self.running = False
+        self.commands.put(None)
+        self.process.join(timeout=3.0)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.thread.join()
+        for ring in self.rings.values():
+            ring.close()
+            ring.unlink()
+
+    def call(self, target, method, *args):
+        """
+        解析プロセス内のオブジェクトのメソッドを呼び出す（戻り値なし）
+        """
+        self.commands.put((target, method, args))
+
+    def __forward(self):
+        """
+        解析プロセスからのログと統計を受け取る
+        """
+        while self.running:
+            try:
+                kind, value = self.events.get(timeout=0.2)
+            except queue.Empty:
+                continue
+            if kind == "log":
+                sys.stdout.write(value)
+            elif kind == "stage":
+                self.stage_stat = value
+
+    def get_stat(self, index):
+        seq, stat = self.rings["stat"].latest()
+        if stat is None:
+            return 0.0
+        return float(stat[index])
+
+    def get_rate_stat(self, indices):
+        """
+        :param indices: RATE_ANALYZE / RATE_FRAME / RATE_SEND
+        :return: RateMeter.get_stat() と同じキーの辞書（count を除く）
+        """
+        return {key: self.get_stat(index) for index, key in zip(indices, RATE_KEYS)}
+
+
+class RemoteTracker:
+
+    def __init__(self, worker, index):
+        self.worker = worker
+        self.index = index
+
+    def get_objects(self):
+        seq, objects = self.worker.rings["objects"].latest()
+        if objects is None:
+            return {}
+        return read_objects(objects[self.index], self.index == 1)
+
+
+class RemoteAnalyzer:
+    """
+    GUIから見た解析プロセスのAnalyzer
+    """
+
+    def __init__(self, worker):
+        self.worker = worker
+        self.touch_tracker = RemoteTracker(worker, 0)
+        self.blob_tracker = RemoteTracker(worker, 1)
+
+        self.curve_type = 0
+        self.threshold = 0.3
+        self.gamma = 0.7
+        self.sd = 16
+        self.mode = 0
+        self.filter_type = "none"
+        self.profiler = None
+
+    @property
+    def output_seq(self):
+        return self.worker.rings["display"].latest()[0]
+
+    @property
+    def disp_img(self):
+        seq, display = self.worker.rings["display"].latest()
+        return None if display is None else display[0]
+
+    @property
+    def disp2_img(self):
+        return self.disp_img
+
+    @property
+    def disp3_img(self):
+        seq, display = self.worker.rings["display"].latest()
+        return None if display is None else display[1]
+
+    def set_grad(self, size, sd):
+        self.sd = sd
+        self.worker.call("analyzer", "set_grad", size, sd)
+
+    def set_curve(self, c_type):
+        self.curve_type = c_type
+        self.worker.call("analyzer", "set_curve", c_type)
+
+    def set_threshold(self, threshold):
+        self.threshold = threshold
+        self.worker.call("analyzer", "set_threshold", threshold)
+
+    def set_curve_param(self, gamma):
+        self.gamma = gamma
+        self.worker.call("analyzer", "set_curve_param", gamma)
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.worker.call("analyzer", "set_mode", mode)
+
+    def set_filter(self, name):
+        self.filter_type = name
+        self.worker.call("analyzer", "set_filter", name)
+
+    def set_baseline_tracking(self, enable):
+        self.worker.call("analyzer", "set_baseline_tracking", enable)
+
+    def set_profiling(self, enable):
+        self.worker.call("analyzer", "set_profiling", enable)
+        if not enable:
+            self.worker.stage_stat = {}
+
+    def get_stage_stat(self):
+        return self.worker.stage_stat
+
+    def get_rate(self):
+        return self.worker.get_stat(STAT_ANALYZE_RATE)
+
+    def get_rate_stat(self):
+        return self.worker.get_rate_stat(RATE_ANALYZE)
+
+    def get_frame_stat(self):
+        return tuple(int(self.worker.get_stat(i)) for i in (STAT_FRAME_SEQ, STAT_DROPPED, STAT_IDLE_WAITS))
+
+
+class RemoteServer:
+
+    def __init__(self, worker, ip):
+        self.worker = worker
+        self.ip = ip
+
+    def set_addr(self, ip, port):
+        self.ip = ip
+        self.worker.call("server", "set_addr", ip, port)
+
+    def start_server(self):
+        self.worker.call("server", "start_server")
+
+    def stop(self):
+        self.worker.call("server", "stop")
+
+    def get_stat(self):
+        """
+        :return: シリアルの (bytes/sec, frames/sec)．シリアル以外の入力なら None
+        """
+        byte_rate = self.worker.get_stat(STAT_SERIAL_BYTES)
+        if byte_rate < 0:
+            return None
+        return byte_rate, self.worker.get_stat(STAT_SERIAL_FRAMES)
+
+
+class RemoteTransmitter:
+
+    MODE_MESSAGE = 0
+    MODE_BUNDLE = 1
+
+    def __init__(self, worker, ip, mode=MODE_MESSAGE):
+        self.worker = worker
+        self.ip = ip
+        self.mode = mode
+
+    def set_addr(self, ip, port):
+        self.ip = ip
+        self.worker.call("client", "set_addr", ip, port)
+
+    def set_mode(self, mode):
+        self.mode = mode
+        self.worker.call("client", "set_mode", mode)
+
+    def set_profiler(self, profiler):
+        # 解析プロセス内で Analyzer.set_profiling と連動する
+        pass
+
+    def start_client(self):
+        self.worker.call("client", "start_client")
+
+    def get_rate(self):
+        return self.worker.get_stat(STAT_SEND_RATE)
+
+    def get_rate_stat(self):
+        return self.worker.get_rate_stat(RATE_SEND)
+
+
+class RemoteCalibration:
+
+    def __init__(self, worker):
+        self.worker = worker
+
+        # 解析プロセスが書き込んだキャリブレーション値（更新されるまで同じ配列を返す）
+        self.seq = 0
+        self.limits = (None, None)
+
+    def __read(self):
+        seq, data = self.worker.rings["calibration"].latest()
+        if seq != self.seq:
+            self.seq = seq
+            self.limits = tuple(None if np.isnan(row).any() else row.copy() for row in data)
+        return self.limits
+
+    @property
+    def cal_min(self):
+        return self.__read()[0]
+
+    @property
+    def cal_max(self):
+        return self.__read()[1]
+
+    def is_calibration_available(self):
+        return self.worker.get_stat(STAT_CALIBRATED) > 0
+
+    def calibration_lower(self):
+        self.worker.call("calibration", "calibration_lower")
+
+    def calibration_upper(self):
+        self.worker.call("calibration", "calibration_upper")
+
+    def save_data(self):
+        self.worker.call("calibration", "save_data")
+
+    def load_data(self):
+        self.worker.call("calibration", "load_data")
+
+
+class RemoteFrame:
+
+    def __init__(self, worker):
+        self.worker = worker
+
+    @property
+    def n_array(self):
+        return self.worker.rings["frame"].latest()[1]
+
+    def get_frame(self):
+        return self.worker.rings["frame"].latest()
+
+    def get_rate(self):
+        return self.worker.get_stat(STAT_FRAME_RATE)
+
+    def get_rate_stat(self):
+        return self.worker.get_rate_stat(RATE_FRAME)
+
+    def get_integrity(self):
+        input_errors = int(self.worker.get_stat(STAT_INPUT_ERRORS))
+        return {
+            "frames": int(self.worker.get_stat(STAT_RECEIVED)),
+            "incomplete_frames": int(self.worker.get_stat(STAT_INCOMPLETE)),
+            "input_errors": input_errors,
+        }
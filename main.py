@@ -1,46 +1,110 @@
-from classes import calibration, connection, controller, analyzer
-from classes.tracker import ObjTracker
-
 import json
+import argparse
 
 
-def load_setting():
-    with open('./settings.json') as f:
-        df = json.load(f)
+def load_setting(path='./settings.json'):
+    try:
+        with open(path) as f:
+            df = json.load(f)
+    except FileNotFoundError:
+        print('Settings file not found: {}'.format(path))
+        df = {}
 
     return df
 
 
-if __name__ == "__main__":
+def parse_args():
+    parser = argparse.ArgumentParser(description="TouchMatrix Server")
+    parser.add_argument("--settings", default="./settings.json", help="settings file")
+    parser.add_argument("--headless", action="store_true", help="run without GUI")
+    parser.add_argument("--process", action="store_true", help="run the analysis in a separate process")
+    parser.add_argument("--sensor", help="serial device of the sensor")
+    parser.add_argument("--obj-ip", help="target IP address of the object messages")
+    parser.add_argument("--replay", help="replay a capture file instead of the sensor")
+    parser.add_argument("--record", help="record sensor frames to a capture file")
+    parser.add_argument("--calibration", help="calibration file")
+    parser.add_argument("--profiling", action="store_true", help="measure the time of each analysis stage")
+    return parser.parse_args()
 
-    # Load Settings
-    param = load_setting()
-
-    # Sharing Data
-    t_frame = connection.TmFrame()
-
-    # create instance
-    t_calibration = calibration.Calibration(t_frame, False)
-    t_touch_track = ObjTracker()
-    t_blob_track = ObjTracker()
-    # t_server = connection.OSCServer(t_frame, "192.168.0.4")
-    t_server = connection.SerialServer(t_frame, param["connection"]["sensor_addr"],
-                                       baud=403200)
-    # t_frame_client = connection.FrameTransmitter(ip='192.168.0.2')
-    t_obj_client = connection.ObjTransmitter(ip=param["connection"]["obj_ip"])
-    t_analyzer = analyzer.Analyzer(t_calibration, t_touch_track, t_blob_track)
+
+def apply_args(param, args):
+    """
+    コマンドライン引数で設定を上書き
+    """
+    con = param.setdefault("connection", {})
+    if args.sensor is not None:
+        con["sensor_addr"] = args.sensor
+    if args.obj_ip is not None:
+        con["obj_ip"] = args.obj_ip
+    if args.replay is not None:
+        con["replay"] = args.replay
+    if args.record is not None:
+        con["record"] = args.record
+    if args.calibration is not None:
+        param["calibration"] = args.calibration
+    if args.headless:
+        param["headless"] = True
+    if args.process:
+        param["analysis_process"] = True
+    if args.profiling:
+        param["profiling"] = True
+    con.setdefault("obj_ip", "127.0.0.1")
+    return param
+
+
+def run_in_process(param):
+    """
+    受信・解析を別プロセスで実行し，GUIは結果の表示のみを行う
+    """
+    from classes import controller, worker
+
+    t_worker = worker.AnalysisProcess(param)
+    t_analyzer = worker.RemoteAnalyzer(t_worker)
+    t_server = worker.RemoteServer(t_worker, param["connection"].get("sensor_addr", ""))
+    t_obj_client = worker.RemoteTransmitter(t_worker, param["connection"]["obj_ip"],
+                                            worker.RemoteTransmitter.MODE_BUNDLE
+                                            if param["connection"].get("obj_bundle", False)
+                                            else worker.RemoteTransmitter.MODE_MESSAGE)
+    t_calibration = worker.RemoteCalibration(t_worker)
+    t_frame = worker.RemoteFrame(t_worker)
+
+    t_worker.start()
+
+    # start gui
     t_view = controller.TmView(t_analyzer, t_server, t_obj_client, t_calibration, t_frame)
+    t_view.mainloop()
+
+    t_worker.stop()
+
 
-    # set draw event callback
-    t_touch_track.set_callback(t_obj_client.send_message)
-    t_blob_track.set_callback(t_obj_client.send_message)
-    t_analyzer.start()
+def run_gui(param):
+    from classes import controller
+    from classes.pipeline import Pipeline
 
-    # t_obj_client.start_client()
+    pipeline = Pipeline(param)
+    t_view = controller.TmView(pipeline.analyzer, pipeline.server, pipeline.client, pipeline.calibration,
+                               pipeline.frame)
+    pipeline.start()
 
     # start gui
     t_view.mainloop()
 
-    t_analyzer.stop()
-    t_server.stop()
-    # t_frame_client.stop()
+    pipeline.stop()
+
+
+if __name__ == "__main__":
+
+    # Load Settings
+    args = parse_args()
+    param = apply_args(load_setting(args.settings), args)
+
+    if param.get("panels"):
+        from classes.tiling import run_tiled
+        run_tiled(param)
+    elif param.get("headless", False):
+        from classes.headless import run_headless
+        run_headless(param)
+    elif param.get("analysis_process", False):
+        run_in_process(param)
+    else:
+        run_gui(param)